@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
-from flask import Flask, request, jsonify, render_template_string, send_from_directory, send_file, redirect, session
+from flask import Flask, Response, request, jsonify, render_template_string, send_from_directory, send_file, redirect, session
 from flask_wtf.csrf import CSRFProtect, generate_csrf
 from netmiko import ConnectHandler, NetMikoTimeoutException, NetMikoAuthenticationException
 import io
-from functools import wraps
-from datetime import datetime
+from functools import wraps, lru_cache
+from datetime import datetime, timedelta
 import time
 import os
 import glob
+import gzip
+import hashlib
 import json
 import zipfile
 import shutil
+import tempfile
 import csv
+from array import array
+import difflib
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 import atexit
@@ -24,8 +29,20 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import ipaddress
 import re
+import sqlite3
+import threading
+import queue
+import random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from markupsafe import escape
 
+# Compressione zstd opzionale per l'archivio dei backup
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 
 __version__ = "1.2.0 stable"
@@ -50,15 +67,60 @@ PASSWORD = os.environ.get('PICKLED_PASSWORD', 'cucumber')
 # Percorsi dei file
 current_dir = os.path.dirname(os.path.abspath(__file__))
 SWITCHES_FILE = os.path.join(current_dir, 'switches.json')
+DB_FILE = os.path.join(current_dir, 'pickled.db')
 SCHEDULES_FILE = os.path.join(current_dir, 'schedules.json')
 KEY_FILE = os.path.join(current_dir, 'encryption.key')
 LOG_DIR = os.path.join(current_dir, 'logs')
 EVENTS_LOG = os.path.join(LOG_DIR, 'events.log')
+# Giorni di log ruotati (compressi con gzip) da conservare
+LOG_RETENTION_DAYS = max(1, int(os.environ.get('PICKLED_LOG_RETENTION_DAYS', '90')))
 BACKUP_DIR = os.path.join(current_dir, 'backups')
+STORE_DIR = os.path.join(BACKUP_DIR, '.store')
+STORE_OBJECTS_DIR = os.path.join(STORE_DIR, 'objects')
+STORE_TMP_DIR = os.path.join(STORE_DIR, 'tmp')
+STORE_MIGRATED_MARKER = os.path.join(STORE_DIR, 'migrated')
+STORE_CATALOG_MARKER = os.path.join(STORE_DIR, 'cataloged')
+STORE_DIFFS_DIR = os.path.join(STORE_DIR, 'diffs')
+STORE_RAW_DIR = os.path.join(STORE_DIR, 'raw')
+# Spazio massimo per le copie decompresse servite da /backup_raw (MB)
+RAW_CACHE_MAX_BYTES = max(1, int(os.environ.get('PICKLED_RAW_CACHE_MB', '64'))) * 1024 * 1024
+# Spazio massimo per i diff calcolati conservati in .store/diffs (MB)
+DIFF_CACHE_MAX_BYTES = max(1, int(os.environ.get('PICKLED_DIFF_CACHE_MB', '32'))) * 1024 * 1024
+STORE_SEARCH_MARKER = os.path.join(STORE_DIR, 'search_indexed')
+# Indice di ricerca: solo l'ultima versione di ogni dispositivo, oppure tutte (PICKLED_SEARCH_ALL_VERSIONS=1)
+SEARCH_ALL_VERSIONS = os.environ.get('PICKLED_SEARCH_ALL_VERSIONS', '0') == '1'
+# Compressione dei blob dell'archivio: 'gzip' (default), 'zstd' (richiede zstandard) o 'none'
+STORE_COMPRESSION = os.environ.get('PICKLED_STORE_COMPRESSION', 'gzip').lower()
+# Versioni intermedie salvate come delta di righe: al massimo N delta tra due keyframe completi (0 = disattivato)
+STORE_DELTA_CHAIN = max(0, int(os.environ.get('PICKLED_STORE_DELTA_CHAIN', '10')))
+# Configurazioni più grandi di così (byte) sono sempre salvate come keyframe completi
+STORE_DELTA_MAX_BYTES = max(0, int(os.environ.get('PICKLED_STORE_DELTA_MAX_BYTES', str(4 * 1024 * 1024))))
+
+# Parametri del motore di backup
+BACKUP_WORKERS_MAX = 64        # sessioni SSH parallele al massimo, qualunque cosa chieda la richiesta
+BACKUP_WORKERS = max(1, min(int(os.environ.get('PICKLED_BACKUP_WORKERS', '8')), BACKUP_WORKERS_MAX))
+BACKUP_JOB_SLOTS = 2           # job di backup asincroni eseguiti contemporaneamente
+# Backup pianificati: ritardo casuale massimo (secondi) applicato a ogni avvio, per non far partire
+# tutte le pianificazioni della stessa ora nello stesso istante (0 = disattivato)
+SCHEDULE_JITTER = max(0, int(os.environ.get('PICKLED_SCHEDULE_JITTER', '0')))
+BACKUP_JOB_RETENTION = 3600    # secondi per cui un job terminato resta consultabile
+SSH_POLL_INTERVAL = 0.2
+# Profili di backup personalizzati (opzionale), uniti a quelli predefiniti per device_type
+BACKUP_PROFILES_FILE = os.path.join(current_dir, 'backup_profiles.json')
+# Politica di conservazione dei backup (assente = nessuna versione viene eliminata automaticamente)
+RETENTION_FILE = os.path.join(current_dir, 'retention.json')
+RETENTION_INTERVAL = max(60, int(os.environ.get('PICKLED_RETENTION_INTERVAL', '3600')))  # secondi tra due passate
+RETENTION_BUDGET = max(1, int(os.environ.get('PICKLED_RETENTION_BUDGET', '500')))        # file eliminati per passata
+# Telemetria dei backup: esecuzioni singole per N giorni, poi aggregate per giorno
+TELEMETRY_RAW_DAYS = max(1, int(os.environ.get('PICKLED_TELEMETRY_RAW_DAYS', '30')))
 
 # Crea le directory necessarie se non esistono
 os.makedirs(LOG_DIR, exist_ok=True)
 os.makedirs(BACKUP_DIR, exist_ok=True)
+os.makedirs(STORE_OBJECTS_DIR, exist_ok=True)
+os.makedirs(STORE_TMP_DIR, exist_ok=True)
+os.makedirs(STORE_RAW_DIR, exist_ok=True)
+os.makedirs(STORE_DIFFS_DIR, exist_ok=True)
 
 # Crea il file di log se non esiste
 if not os.path.exists(EVENTS_LOG):
@@ -74,20 +136,259 @@ for handler in logger.handlers[:]:
 # Configura il livello del logger
 logger.setLevel(logging.INFO)
 
+class BatchedFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """Leaves the stream buffered between records: the log writer flushes it once per batch."""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+ROTATED_LOG_RE = re.compile(r'^events\.log\.(\d{4}-\d{2}-\d{2})\.log(\.gz)?$')
+
+def archive_rotated_logs():
+    """Compresses rotated log files with gzip and removes the archives older than LOG_RETENTION_DAYS."""
+    cutoff = (datetime.now() - timedelta(days=LOG_RETENTION_DAYS)).strftime('%Y-%m-%d')
+    for filename in sorted(os.listdir(LOG_DIR)):
+        match = ROTATED_LOG_RE.match(filename)
+        if not match:
+            continue
+        path = os.path.join(LOG_DIR, filename)
+        try:
+            if match.group(1) < cutoff:
+                os.remove(path)
+            elif not match.group(2):
+                with open(path, 'rb') as src, gzip.open(path + '.gz.part', 'wb', compresslevel=9) as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(path + '.gz.part', path + '.gz')
+                os.remove(path)
+        except OSError as e:
+            logger.error(f"Unable to archive log file {filename}: {str(e)}")
+    prune_event_records(cutoff)
+
+def rotate_log(source, dest):
+    os.rename(source, dest)
+    archive_rotated_logs()
+
 # Crea UN SINGOLO handler per il file di log
-file_handler = logging.handlers.TimedRotatingFileHandler(
+file_handler = BatchedFileHandler(
     EVENTS_LOG,
     when='midnight',
     interval=1,
-    backupCount=7,  # Mantieni 7 backup
+    backupCount=0,  # La conservazione è gestita da archive_rotated_logs (LOG_RETENTION_DAYS)
     encoding='utf-8',
     delay=False
 )
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
 file_handler.suffix = "%Y-%m-%d.log"  # Formato data standard
+file_handler.rotator = rotate_log
+
+# Gli handler reali sono collegati al thread di scrittura dei log (vedi log_writer più sotto)
+
+# Bus degli eventi live (SSE): ogni dashboard connessa riceve gli eventi su una propria coda limitata
+EVENT_QUEUE_SIZE = 1000
+event_subscribers = set()
+event_subscribers_lock = threading.Lock()
+# Eventi solo per le dashboard connesse, non salvati nel registro strutturato
+LIVE_ONLY_EVENTS = {'log', 'backup_job'}
+
+def publish_event(event_type, **data):
+    event = {'type': event_type, 'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), **data}
+    if event_type not in LIVE_ONLY_EVENTS:
+        # Scritto e indicizzato dal thread dei log, insieme agli altri record del batch
+        event_logger.info(event_type, extra={'event': event})
+    with event_subscribers_lock:
+        subscribers = list(event_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            pass  # Dashboard troppo lenta: l'evento viene scartato solo per lei
+
+class EventBusHandler(logging.Handler):
+    """Publishes every events.log line on the live event bus."""
+
+    def emit(self, record):
+        try:
+            publish_event('log', line=self.format(record))
+        except Exception:
+            self.handleError(record)
+
+event_bus_handler = EventBusHandler()
+event_bus_handler.setFormatter(file_handler.formatter)
+
+# Registro strutturato degli eventi: una riga JSON per evento nel file del giorno, accanto al log testuale,
+# indicizzata per tempo e dispositivo nella tabella event_index
+EVENT_INDEX_FIELDS = ['time', 'event_type', 'device_id', 'hostname', 'phase', 'outcome', 'duration', 'error_type', 'file', 'offset']
+EVENTS_JSONL_RE = re.compile(r'^events\.(\d{4}-\d{2}-\d{2})\.jsonl$')
+
+def events_jsonl_path(day):
+    return os.path.join(LOG_DIR, f'events.{day}.jsonl')
+
+def store_events(events):
+    """Appends a batch of events to the daily jsonl files and indexes them in one transaction; failures are logged."""
+    rows, f, day = [], None, None
+    try:
+        try:
+            for event in events:
+                if event['time'][:10] != day:
+                    if f:
+                        f.close()
+                    day = event['time'][:10]
+                    f = open(events_jsonl_path(day), 'a', encoding='utf-8')
+                offset = f.tell()
+                f.write(json.dumps(event, default=str, separators=(',', ':')) + '\n')
+                outcome = None
+                if 'success' in event:
+                    outcome = 'success' if event['success'] else 'failure'
+                rows.append((event['time'], event['type'], event.get('id'), event.get('hostname'), event.get('phase'), outcome,
+                             event.get('duration'), event.get('error_type'), os.path.basename(f.name), offset))
+        finally:
+            if f:
+                f.close()
+        conn = get_db()
+        with conn:
+            conn.executemany(
+                f"INSERT INTO event_index ({', '.join(EVENT_INDEX_FIELDS)}) VALUES ({', '.join('?' * len(EVENT_INDEX_FIELDS))})",
+                rows
+            )
+    except Exception as e:
+        logger.error(f"Unable to record a batch of {len(events)} events: {str(e)}")
+
+class EventStoreHandler(logging.Handler):
+    """Collects the structured events of a log batch; the log writer stores them all at once on flush_batch."""
+
+    def __init__(self):
+        super().__init__()
+        self._pending = []
+        self.addFilter(lambda record: hasattr(record, 'event'))
+
+    def emit(self, record):
+        self._pending.append(record.event)
+
+    def flush_batch(self):
+        if self._pending:
+            events, self._pending = self._pending, []
+            store_events(events)
+
+def prune_event_records(cutoff):
+    """Drops the events older than cutoff (YYYY-MM-DD) from the index and their daily files, like the rotated logs."""
+    try:
+        conn = get_db()
+        with conn:
+            conn.execute('DELETE FROM event_index WHERE time < ?', (cutoff,))
+        for filename in os.listdir(LOG_DIR):
+            match = EVENTS_JSONL_RE.match(filename)
+            if match and match.group(1) < cutoff:
+                os.remove(os.path.join(LOG_DIR, filename))
+    except Exception as e:
+        logger.error(f"Unable to prune event records: {str(e)}")
+
+# Pipeline di logging non bloccante: chi logga accoda il record, un solo thread lo scrive su disco
+LOG_BATCH_SIZE = 500
+LOG_QUEUE_SIZE = 10000  # record in attesa al massimo: oltre, se il writer è bloccato, vengono scartati e contati
+
+class LogWriter:
+    """Single consumer of the log queue: hands records to the handlers in batches, flushing once per batch."""
+
+    _STOP = object()
+
+    def __init__(self, log_queue, *handlers):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.dropped = 0
+        self._reported = 0
+        self._dropped_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
 
-# Aggiungi SOLO QUESTO handler
-logger.addHandler(file_handler)
+    def stop(self):
+        """Writes out every queued record, then ends the writer thread."""
+        if self._thread and self._thread.is_alive():
+            self.queue.put(self._STOP)
+            self._thread.join()
+        self._thread = None
+
+    def submit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def _dispatch(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                # Un handler in errore (disco pieno, database bloccato) non deve fermare il thread
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = False
+            last = None
+            for record in batch:
+                if record is self._STOP:
+                    stopping = True
+                    continue
+                self._dispatch(record)
+                last = record
+            if self.dropped != self._reported:
+                lost, self._reported = self.dropped - self._reported, self.dropped
+                self._dispatch(logging.LogRecord(
+                    logger.name, logging.WARNING, __file__, 0,
+                    f"Log queue full: {lost} records dropped ({self._reported} in total)", None, None
+                ))
+            for handler in self.handlers:
+                if hasattr(handler, 'flush_batch'):
+                    try:
+                        handler.flush_batch()
+                    except Exception:
+                        handler.handleError(last)
+            if stopping:
+                return
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the log writer, which drops them (and counts them) when its queue is full."""
+
+    def __init__(self, writer):
+        super().__init__(writer.queue)
+        self.writer = writer
+
+    def enqueue(self, record):
+        self.writer.submit(record)
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+event_store_handler = EventStoreHandler()
+log_writer = LogWriter(log_queue, file_handler, event_bus_handler, event_store_handler)
+log_queue_handler = LogQueueHandler(log_writer)
+logger.addHandler(log_queue_handler)
+
+# Gli eventi strutturati viaggiano sulla stessa coda, come record con attributo 'event'
+event_logger = logging.getLogger(__name__ + '.events')
+event_logger.setLevel(logging.INFO)
+event_logger.propagate = False
+event_logger.addHandler(log_queue_handler)
+for handler in (file_handler, event_bus_handler):
+    handler.addFilter(lambda record: not hasattr(record, 'event'))
+log_writer.start()
+
+def read_event_record(filename, offset):
+    with open(os.path.join(LOG_DIR, os.path.basename(filename)), 'r', encoding='utf-8') as f:
+        f.seek(offset)
+        return json.loads(f.readline())
 
 # Disabilita il logging di Werkzeug
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
@@ -95,7 +396,12 @@ logging.getLogger('werkzeug').setLevel(logging.WARNING)
 # Inizializzazione dello scheduler
 scheduler = BackgroundScheduler()
 scheduler.start()
-atexit.register(lambda: scheduler.shutdown())
+def shutdown_background_services():
+    scheduler.shutdown()
+    # Ultimo passo: i record ancora in coda vengono scritti prima dell'uscita
+    log_writer.stop()
+
+atexit.register(shutdown_background_services)
 
 limiter = Limiter(
     app=app,
@@ -1219,6 +1525,9 @@ HTML_TEMPLATE = r"""
                             <button class="search-button exp-btn" onclick="exportSwitchesToCSV()">
                                 <i class="fas fa-file-export"></i> Export
                             </button>
+                            <button class="search-button exp-btn" onclick="exportConfigsZip()">
+                                <i class="fas fa-file-archive"></i> Export Configs
+                            </button>
                             <button class="search-button backup-btn" onclick="backupAllSwitches()">
                                 <i class="fas fa-download"></i> Backup All
                             </button>
@@ -1286,6 +1595,16 @@ HTML_TEMPLATE = r"""
                         <input type="time" id="schedule-time" class="form-control" value="00:00">
                     </div>
 
+                    <div class="form-group">
+                        <label for="schedule-window">Spread over (minutes, 0 = all at once):</label>
+                        <input type="number" id="schedule-window" class="form-control" min="0" max="1440" value="0">
+                    </div>
+
+                    <div class="form-group">
+                        <label for="schedule-concurrency">Max parallel backups (empty = default):</label>
+                        <input type="number" id="schedule-concurrency" class="form-control" min="1" max="64" value="">
+                    </div>
+
                     <!-- Opzioni specifiche per tipo -->
                     <div id="once-option" class="schedule-option">
                         <div class="form-group">
@@ -1469,10 +1788,20 @@ HTML_TEMPLATE = r"""
                     <div class="modal-title">Complete log activity</div>
                     <span class="close-btn" onclick="closeLogModal()">&times;</span>
                 </div>
+                <div style="display: flex; gap: 10px; margin-bottom: 10px;">
+                    <select id="log-filter-level" onchange="reloadLogPage()">
+                        <option value="">All levels</option>
+                        <option value="INFO">Info and above</option>
+                        <option value="WARNING">Warnings and errors</option>
+                        <option value="ERROR">Errors only</option>
+                    </select>
+                    <input type="text" id="log-filter-hostname" placeholder="Hostname..." onchange="reloadLogPage()">
+                </div>
                 <div class="modal-body">
                     <div id="full-log-content" class="log-content"></div>
                 </div>
                 <div style="text-align: right; margin-top: 20px;">
+                    <button id="log-older-btn" onclick="loadLogPage(false)" style="display: none;">Older entries</button>
                     <button onclick="closeLogModal()">Close</button>
                 </div>
             </div>
@@ -1911,6 +2240,7 @@ HTML_TEMPLATE = r"""
                         const statusMessage = `Starting backup for ${switchData.hostname} (${switchData.ip})...`;
                         showStatus(statusMessage, 'success');
                         addToLog(statusMessage);
+                        manualBackups.add(switchData.hostname);
 
                         // Poi eseguiamo il backup
                         fetch('/backup_switch', {
@@ -1938,7 +2268,8 @@ HTML_TEMPLATE = r"""
                             const errorMessage = `Connection error for ${switchData.hostname}: ${error}`;
                             showStatus(errorMessage, 'error');
                             addToLog(`ERROR - Connection failed for ${switchData.hostname}: ${error}`);
-                        });
+                        })
+                        .finally(() => manualBackups.delete(switchData.hostname));
                     }
                 })
                 .catch(error => {
@@ -1989,19 +2320,13 @@ HTML_TEMPLATE = r"""
                         'Content-Type': 'application/json',
                         'X-CSRFToken': getCSRFToken()
                     },
+                    body: JSON.stringify({ async: true }),
                 })
                 .then(response => response.json())
                 .then(data => {
                     if (data.success) {
-                        const successMessage = `Backup completed for ${data.count} devices`;
-                        showStatus(successMessage, 'success');
-                        data.results.forEach(result => {
-                            if (result.success) {
-                                addToLog(`Backup completed for ${result.hostname} (${result.ip})`);
-                            } else {
-                                addToLog(`ERROR during the backup of ${result.hostname}: ${result.message}`);
-                            }
-                        });
+                        addToLog(`Backup job ${data.job_id} queued for ${data.total} devices`);
+                        trackBackupJob(data.job_id);
                     } else {
                         const errorMessage = `Backup error: ${data.message}`;
                         showStatus(errorMessage, 'error');
@@ -2013,6 +2338,85 @@ HTML_TEMPLATE = r"""
                 });
             }
 
+            // Eventi live dal server (SSE): log dei backup e avanzamento dei job senza polling
+            const trackedBackupJobs = new Set();
+            const manualBackups = new Set();  // hostname dei backup singoli, già riportati da backupSwitch
+            const backupPhaseLabels = {
+                connect: 'Connecting to',
+                retrieve: 'Executing configuration retrieval on',
+                fallback: 'Falling back to the alternate method on'
+            };
+
+            function connectEventStream() {
+                if (!window.EventSource) return;
+                const source = new EventSource('/events/stream');
+                source.addEventListener('open', () => {
+                    // Dopo una riconnessione lo stato dei job seguiti si riallinea con una sola richiesta
+                    trackedBackupJobs.forEach(jobId => refreshBackupJob(jobId));
+                });
+                source.addEventListener('backup_start', e => {
+                    const event = JSON.parse(e.data);
+                    if (!manualBackups.has(event.hostname)) {
+                        addToLog(`Starting backup for ${event.hostname} (${event.ip})`);
+                    }
+                });
+                source.addEventListener('backup_phase', e => {
+                    const event = JSON.parse(e.data);
+                    addToLog(`${backupPhaseLabels[event.phase] || event.phase} ${event.hostname}`);
+                });
+                source.addEventListener('backup_finish', e => {
+                    const event = JSON.parse(e.data);
+                    if (manualBackups.has(event.hostname)) return;
+                    if (event.success) {
+                        addToLog(`Backup completed for ${event.hostname} (${event.ip})`);
+                    } else {
+                        addToLog(`ERROR during the backup of ${event.hostname || 'device ' + event.id}: ${event.message}`);
+                    }
+                });
+                source.addEventListener('backup_job', e => {
+                    const job = JSON.parse(e.data);
+                    if (trackedBackupJobs.has(job.job_id)) showBackupJobProgress(job);
+                });
+            }
+
+            // Avanzamento di un job di backup asincrono: aggiornato dagli eventi 'backup_job'
+            function trackBackupJob(jobId) {
+                trackedBackupJobs.add(jobId);
+                refreshBackupJob(jobId);
+            }
+
+            function refreshBackupJob(jobId) {
+                fetch(`/backup_jobs/${jobId}`)
+                .then(response => response.json())
+                .then(job => {
+                    if (!job.success) {
+                        trackedBackupJobs.delete(jobId);
+                        showStatus(`Backup error: ${job.message}`, 'error');
+                        return;
+                    }
+                    showBackupJobProgress(job);
+                })
+                .catch(error => {
+                    showStatus(`Connection error: ${error}`, 'error');
+                });
+            }
+
+            function showBackupJobProgress(job) {
+                if (!trackedBackupJobs.has(job.job_id)) return;
+                if (job.status === 'queued' || job.status === 'running') {
+                    showStatus(`Backup in progress: ${job.done}/${job.total} devices`, 'success');
+                    return;
+                }
+                trackedBackupJobs.delete(job.job_id);
+                if (job.status === 'completed') {
+                    showStatus(`Backup completed for ${job.count} devices`, 'success');
+                    addToLog(`Backup job ${job.job_id} completed: ${job.count}/${job.total} devices`);
+                    updateSwitchTable();
+                } else {
+                    showStatus(`Backup error: ${job.message}`, 'error');
+                }
+            }
+
             function openConfigModal(index) {
                 fetch('/get_switch_backups', {
                     method: 'POST',
@@ -2056,15 +2460,11 @@ HTML_TEMPLATE = r"""
             }
 
             function loadBackupContent(filepath, switchIndex) {
-                fetch('/get_backup_content', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'X-CSRFToken': getCSRFToken()
-                    },
-                    body: JSON.stringify({ filepath }),
-                })
-                .then(response => response.json())
+                // Testo grezzo: il browser lo rivalida con l'ETag invece di riscaricarlo
+                fetch('/backup_raw?path=' + encodeURIComponent(filepath), { cache: 'no-cache' })
+                .then(response => response.ok
+                    ? response.text().then(content => ({ success: true, content, filename: filepath.split('/').pop() }))
+                    : response.json())
                 .then(data => {
                     if (data.success) {
                         const contentDiv = document.getElementById('backup-content');
@@ -2086,28 +2486,23 @@ HTML_TEMPLATE = r"""
                         document.querySelectorAll('.backup-item').forEach(item => {
                             item.classList.toggle('active', item.textContent.includes(data.filename));
                         });
+                    } else {
+                        showStatus('Error: ' + data.message, 'error');
                     }
                 });
             }
 
             function exportBackup() {
-                const configContent = document.querySelector('#backup-content .config-content').textContent;
+                const filepath = document.getElementById('delete-backup-btn').getAttribute('data-filepath');
                 const filename = document.querySelector('.backup-item.active').textContent;
 
-                // Crea un blob con il contenuto
-                const blob = new Blob([configContent], { type: 'text/plain' });
-                const url = URL.createObjectURL(blob);
-
-                // Crea un link temporaneo e simula il click
+                // Download diretto dal server, senza passare dal contenuto mostrato
                 const a = document.createElement('a');
-                a.href = url;
+                a.href = '/backup_raw?download=1&path=' + encodeURIComponent(filepath);
                 a.download = filename;
                 document.body.appendChild(a);
                 a.click();
-
-                // Pulisci
                 document.body.removeChild(a);
-                URL.revokeObjectURL(url);
 
                 showStatus('Backup exported successfully', 'success');
                 addToLog(`Exported backup: ${filename}`);
@@ -2301,25 +2696,50 @@ HTML_TEMPLATE = r"""
 
 
 
-            function openLogModal() {
-                fetch('/get_full_log')
+            let logCursor = null;
+
+            function loadLogPage(reset) {
+                // Pagine di log dalla più recente; il cursore porta alla pagina precedente
+                const params = new URLSearchParams({ limit: 200 });
+                const level = document.getElementById('log-filter-level').value;
+                const hostname = document.getElementById('log-filter-hostname').value.trim();
+                if (level) params.set('level', level);
+                if (hostname) params.set('hostname', hostname);
+                if (!reset && logCursor) params.set('cursor', logCursor);
+
+                return fetch('/get_log_page?' + params.toString())
                 .then(response => response.json())
                 .then(data => {
                     if (data.success) {
-                        const modal = document.getElementById('log-modal');
                         const logContent = document.getElementById('full-log-content');
-
-                        // Pulisci e formatta il log
-                        const lines = data.log.match(/[^\r\n]+/g) || [];
-                        logContent.innerHTML = lines
-                        .filter(line => line.trim())
-                        .map(line => `<div class="log-line">${line}</div>`)
+                        const html = data.entries
+                        .map(entry => `<div class="log-line">${entry.time} - ${entry.level} - ${entry.message}</div>`)
                         .join('');
-
-                        modal.style.display = 'block';
+                        if (reset) {
+                            logContent.innerHTML = html;
+                        } else {
+                            logContent.insertAdjacentHTML('beforeend', html);
+                        }
+                        logCursor = data.next_cursor;
+                        document.getElementById('log-older-btn').style.display = data.next_cursor ? 'inline-block' : 'none';
                     } else {
                         showStatus('Error: ' + data.message, 'error');
                     }
+                    return data;
+                });
+            }
+
+            function reloadLogPage() {
+                logCursor = null;
+                loadLogPage(true);
+            }
+
+            function openLogModal() {
+                logCursor = null;
+                loadLogPage(true).then(data => {
+                    if (data.success) {
+                        document.getElementById('log-modal').style.display = 'block';
+                    }
                 });
 
                 document.addEventListener('keydown', handleEscLogModal);
@@ -2374,6 +2794,12 @@ HTML_TEMPLATE = r"""
                     enabled: true
                 };
 
+                // Distribuzione del backup globale nella finestra, con limite di backup contemporanei
+                const spreadMinutes = parseInt(document.getElementById('schedule-window').value, 10);
+                const concurrency = parseInt(document.getElementById('schedule-concurrency').value, 10);
+                if (spreadMinutes > 0) scheduleData.window = spreadMinutes;
+                if (concurrency > 0) scheduleData.concurrency = concurrency;
+
                 if (type === 'once') {
                     const date = document.getElementById('schedule-date').value;
                     if (!date) {
@@ -2551,6 +2977,13 @@ onclick="toggleSchedule('${schedule.id}', ${!schedule.enabled})">
                 });
             }
 
+            function exportConfigsZip() {
+                // Download in streaming gestito dal browser, senza caricare lo ZIP in memoria
+                const query = document.getElementById('search-input').value.trim();
+                window.location.href = '/export_backups_zip' + (query ? '?hostname=' + encodeURIComponent(query) : '');
+                addToLog('Avviata esportazione ZIP delle configurazioni' + (query ? ' (filtro: ' + query + ')' : ''));
+            }
+
             function setupModalCloseOnEsc() {
                 // Chiudi modali quando si preme ESC
                 document.addEventListener('keydown', function(event) {
@@ -2600,6 +3033,7 @@ onclick="toggleSchedule('${schedule.id}', ${!schedule.enabled})">
 
             document.addEventListener('DOMContentLoaded', function() {
                 updateSwitchTable();
+                connectEventStream();
                 showScheduleOptions();
                 updateSchedulesList();
 
@@ -2685,53 +3119,378 @@ def decrypt_password(encrypted_password):
     return fernet.decrypt(encrypted_password.encode()).decode()
 
 # Funzioni di persistenza dati
-def load_switches():
-    try:
-        if not os.path.exists(SWITCHES_FILE):
-            return []
+# Colonne dell'inventario dispositivi (tabella switches)
+SWITCH_FIELDS = ['hostname', 'ip', 'username', 'password', 'enable_password', 'device_type',
+                 'backup_command', 'last_backup_status', 'last_backup_time']
+
+# Una connessione SQLite per thread (request Flask, worker di backup, scheduler)
+_db_local = threading.local()
+
+def get_db():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _db_local.conn = conn
+    return conn
+
+def init_db():
+    conn = get_db()
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS switches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hostname TEXT NOT NULL,
+                ip TEXT NOT NULL,
+                username TEXT,
+                password TEXT,
+                enable_password TEXT,
+                device_type TEXT,
+                backup_command TEXT,
+                last_backup_status TEXT,
+                last_backup_time TEXT
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_switches_ip ON switches (ip)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_switches_hostname ON switches (hostname)')
+        # Catalogo delle versioni di backup: una riga per file di versione in backups/<folder>/
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS backup_catalog (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                folder TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                size INTEGER,
+                line_count INTEGER,
+                content_hash TEXT,
+                method TEXT,
+                duration REAL,
+                UNIQUE (folder, filename)
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_catalog_hash ON backup_catalog (content_hash)')
+        # Indice full-text: righe per contenuto (search_lines) e versioni ricercabili (search_versions)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS search_versions (
+                folder TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                PRIMARY KEY (folder, filename)
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_search_versions_hash ON search_versions (content_hash)')
+        # Per ogni contenuto indicizzato, l'intervallo di rowid delle sue righe in search_lines
+        conn.execute('CREATE TABLE IF NOT EXISTS search_blobs (content_hash TEXT PRIMARY KEY, first_rowid INTEGER, last_rowid INTEGER)')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS event_index (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                time TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                device_id INTEGER,
+                hostname TEXT,
+                phase TEXT,
+                outcome TEXT,
+                duration REAL,
+                error_type TEXT,
+                file TEXT NOT NULL,
+                offset INTEGER NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_event_time ON event_index (time)')
+        # Telemetria: una riga per esecuzione (backup_runs), aggregati giornalieri per i dati più vecchi
+        # Fasi: connect_time (apertura SSH, anche se fallisce), setup_time (enable, prompt, paginazione), retrieve_time
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS backup_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                hostname TEXT,
+                started_at TEXT NOT NULL,
+                connect_time REAL,
+                setup_time REAL,
+                retrieve_time REAL,
+                total_time REAL,
+                bytes INTEGER,
+                lines INTEGER,
+                method TEXT,
+                outcome TEXT,
+                error_type TEXT
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_runs_device ON backup_runs (device_id, started_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_runs_started ON backup_runs (started_at)')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS backup_runs_daily (
+                device_id INTEGER NOT NULL,
+                hostname TEXT,
+                day TEXT NOT NULL,
+                runs INTEGER,
+                failures INTEGER,
+                avg_connect REAL,
+                avg_setup REAL,
+                avg_retrieve REAL,
+                avg_total REAL,
+                max_total REAL,
+                avg_bytes REAL,
+                avg_lines REAL,
+                PRIMARY KEY (device_id, day)
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_event_device ON event_index (device_id, time)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_event_type ON event_index (event_type, time)')
+        # Blob salvati come delta e relativo blob di base (tenuto in vita finché un delta lo usa)
+        conn.execute('CREATE TABLE IF NOT EXISTS store_deltas (digest TEXT PRIMARY KEY, base TEXT NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_store_deltas_base ON store_deltas (base)')
+        try:
+            # Tokenizer trigram: ricerca per sottostringa accelerata dall'indice (SQLite >= 3.34)
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_lines USING fts5(text, content_hash UNINDEXED, line_no UNINDEXED, tokenize='trigram')")
+        except sqlite3.OperationalError:
+            # SQLite senza FTS5 o trigram: tabella semplice, ricerca con LIKE
+            conn.execute('CREATE TABLE IF NOT EXISTS search_lines (text TEXT, content_hash TEXT, line_no INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_search_lines_hash ON search_lines (content_hash)')
+    migrate_switches_json()
+
+def migrate_switches_json():
+    """Imports the legacy switches.json inventory into SQLite once, then renames the file."""
+    if not os.path.exists(SWITCHES_FILE):
+        return
+
+    conn = get_db()
+    if conn.execute('SELECT COUNT(*) FROM switches').fetchone()[0] > 0:
+        logger.warning(f"Inventory database already populated, ignoring {SWITCHES_FILE}")
+        return
 
+    try:
         with open(SWITCHES_FILE, 'r', encoding='utf-8-sig') as f:
             content = f.read().strip()
-            if not content:
-                return []
-            
-            switches_data = json.loads(content)
-            
-            # Correzione: garantiamo che enable_password sia sempre valorizzato
-            for switch in switches_data:
-                if not switch.get('enable_password'):
-                    switch['enable_password'] = switch['password']
-            
-            return switches_data
-            
-    except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON in switches file: {str(e)}")
-        return []
-    except Exception as e:
+        switches_data = json.loads(content) if content else []
+    except (json.JSONDecodeError, OSError) as e:
+        logger.error(f"Unable to migrate switches file: {str(e)}")
+        return
+
+    insert_switches(switches_data)
+    os.replace(SWITCHES_FILE, SWITCHES_FILE + '.migrated')
+    logger.info(f"Migrated {len(switches_data)} devices from {SWITCHES_FILE} to {DB_FILE}")
+
+def _row_to_switch(row):
+    switch = dict(row)
+    switch['device_type'] = switch.get('device_type') or 'cisco_ios'
+    # Correzione: garantiamo che enable_password sia sempre valorizzato
+    if not switch.get('enable_password'):
+        switch['enable_password'] = switch['password']
+    return switch
+
+# Cache in memoria dell'inventario, invalidata dal contatore di generazione delle scritture
+_inventory_lock = threading.Lock()
+_inventory_generation = 0
+_inventory_cache = {'generation': None, 'switches': [], 'by_id': {}}
+
+def _invalidate_inventory(switch_id=None, fields=None):
+    """
+    Bumps the write generation after a committed change. When switch_id and fields are
+    given and the cached snapshot is current, the cached row is patched in place instead
+    of being discarded.
+    """
+    global _inventory_generation
+    with _inventory_lock:
+        cache_is_current = _inventory_cache['generation'] == _inventory_generation
+        _inventory_generation += 1
+        if cache_is_current and switch_id in _inventory_cache['by_id'] and fields:
+            patched = _row_to_switch({**_inventory_cache['by_id'][switch_id], **fields})
+            switches = [patched if sw['id'] == switch_id else sw for sw in _inventory_cache['switches']]
+            _inventory_cache.update(generation=_inventory_generation, switches=switches,
+                                    by_id={**_inventory_cache['by_id'], switch_id: patched})
+
+def _inventory_snapshot():
+    """Returns (switches, by_id) for the current generation, reading the database only on a miss."""
+    with _inventory_lock:
+        generation = _inventory_generation
+        if _inventory_cache['generation'] == generation:
+            return _inventory_cache['switches'], _inventory_cache['by_id']
+
+    rows = get_db().execute('SELECT * FROM switches ORDER BY id').fetchall()
+    switches = [_row_to_switch(row) for row in rows]
+    by_id = {sw['id']: sw for sw in switches}
+
+    with _inventory_lock:
+        # Una scrittura concorrente durante la lettura rende lo snapshot già vecchio
+        if _inventory_generation == generation:
+            _inventory_cache.update(generation=generation, switches=switches, by_id=by_id)
+    return switches, by_id
+
+def load_switches():
+    try:
+        switches, _ = _inventory_snapshot()
+        return [dict(sw) for sw in switches]
+    except sqlite3.Error as e:
         logger.error(f"Error loading switches: {str(e)}")
         return []
 
-def save_switches(switches_data):
-    with open(SWITCHES_FILE, 'w') as f:
-        json.dump(switches_data, f, indent=4)
+def get_switch(index):
+    """Returns the device at list position index (same ordering as load_switches), or None."""
+    switches, _ = _inventory_snapshot()
+    if 0 <= index < len(switches):
+        return dict(switches[index])
+    return None
+
+def get_switch_by_id(switch_id):
+    _, by_id = _inventory_snapshot()
+    switch = by_id.get(switch_id)
+    return dict(switch) if switch else None
+
+def switch_ip_exists(ip):
+    return get_db().execute('SELECT 1 FROM switches WHERE ip = ? LIMIT 1', (ip,)).fetchone() is not None
+
+def insert_switches(switches_data):
+    conn = get_db()
+    with conn:
+        cursor = conn.executemany(
+            f"INSERT INTO switches ({', '.join(SWITCH_FIELDS)}) VALUES ({', '.join('?' * len(SWITCH_FIELDS))})",
+            [[switch.get(field) for field in SWITCH_FIELDS] for switch in switches_data]
+        )
+    _invalidate_inventory()
+    return cursor.rowcount
+
+def insert_switch(switch_data):
+    conn = get_db()
+    with conn:
+        cursor = conn.execute(
+            f"INSERT INTO switches ({', '.join(SWITCH_FIELDS)}) VALUES ({', '.join('?' * len(SWITCH_FIELDS))})",
+            [switch_data.get(field) for field in SWITCH_FIELDS]
+        )
+    _invalidate_inventory()
+    return cursor.lastrowid
+
+def update_switch_row(switch_id, fields):
+    fields = {k: v for k, v in fields.items() if k in SWITCH_FIELDS}
+    if not fields:
+        return
+    conn = get_db()
+    with conn:
+        conn.execute(
+            f"UPDATE switches SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+            [*fields.values(), switch_id]
+        )
+    _invalidate_inventory(switch_id, fields)
+
+def delete_switch_row(switch_id):
+    conn = get_db()
+    with conn:
+        conn.execute('DELETE FROM switches WHERE id = ?', (switch_id,))
+    _invalidate_inventory()
+
+def set_backup_status(switch_id, status):
+    update_switch_row(switch_id, {
+        'last_backup_status': status,
+        'last_backup_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    })
 
-def load_schedules():
+# Inizializzazione del database inventario
+init_db()
+
+# Servizio delle pianificazioni: schedules.json viene letto una sola volta all'avvio, poi il registro
+# in memoria è la fonte autorevole; ogni modifica aggiorna registro, file e scheduler insieme
+schedules_registry = []
+schedules_lock = threading.RLock()
+
+def read_schedules_file():
     try:
         if os.path.exists(SCHEDULES_FILE):
             with open(SCHEDULES_FILE, 'r') as f:
-                schedules = json.load(f)
-                for schedule in schedules:
-                    if schedule.get('enabled', True):
-                        add_scheduled_job(schedule)
-                return schedules
+                return json.load(f)
         return []
     except (json.JSONDecodeError, FileNotFoundError) as e:
-        logger.error(f"Error during schedule update: {str(e)}")
+        logger.error(f"Error while reading schedules: {str(e)}")
         return []
 
 def save_schedules(schedules_data):
-    with open(SCHEDULES_FILE, 'w') as f:
+    fd, temp_path = tempfile.mkstemp(prefix='schedules_', suffix='.part', dir=current_dir)
+    with os.fdopen(fd, 'w') as f:
         json.dump(schedules_data, f, indent=4)
+    os.replace(temp_path, SCHEDULES_FILE)
+
+def load_schedules():
+    """Copy of the registered schedules; never touches the scheduler."""
+    with schedules_lock:
+        return [dict(schedule) for schedule in schedules_registry]
+
+def _schedule_expired(schedule):
+    if schedule['type'] != 'once':
+        return False
+    run_date = datetime.strptime(f"{schedule['date']} {schedule['time']}", '%Y-%m-%d %H:%M')
+    return run_date <= datetime.now()
+
+def bootstrap_schedules():
+    """Loads schedules.json into the registry and registers the enabled jobs; run once at startup."""
+    registered = 0
+    with schedules_lock:
+        schedules_registry[:] = read_schedules_file()
+        for schedule in schedules_registry:
+            if not schedule.get('enabled', True):
+                continue
+            try:
+                if _schedule_expired(schedule):
+                    continue
+                add_scheduled_job(schedule)
+                registered += 1
+            except (KeyError, ValueError) as e:
+                logger.error(f"Invalid schedule {schedule.get('id')}: {str(e)}")
+    logger.info(f"Schedules restored: {registered} of {len(schedules_registry)} active")
+
+SCHEDULE_DISPATCH_LIMITS = {'window': (0, 1440), 'concurrency': (1, BACKUP_WORKERS_MAX), 'jitter': (0, 3600), 'dispatch_jitter': (0, 3600)}
+
+def _schedule_int(key, value):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{key} must be an integer")
+    return int(value)
+
+def create_schedule(data):
+    if not isinstance(data.get('time'), str):
+        raise ValueError("time must be a string (HH:MM)")
+    for key, (low, high) in SCHEDULE_DISPATCH_LIMITS.items():
+        if key in data:
+            data[key] = _schedule_int(key, data[key])
+            if not low <= data[key] <= high:
+                raise ValueError(f"{key} must be between {low} and {high}")
+    if 'switch_ids' in data:
+        if not isinstance(data['switch_ids'], list):
+            raise ValueError("switch_ids must be a list of device ids")
+        data['switch_ids'] = [_schedule_int('switch_ids', switch_id) for switch_id in data['switch_ids']]
+    with schedules_lock:
+        data['id'] = f"sch_{int(time.time())}_{len(schedules_registry)}"
+        data['created_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        data['enabled'] = True
+        add_scheduled_job(data)
+        schedules_registry.append(data)
+        save_schedules(schedules_registry)
+    return data
+
+def set_schedule_enabled(schedule_id, enabled):
+    with schedules_lock:
+        schedule = next((s for s in schedules_registry if s['id'] == schedule_id), None)
+        if not schedule:
+            return None
+        if enabled:
+            add_scheduled_job(schedule)
+        elif scheduler.get_job(schedule_id):
+            scheduler.remove_job(schedule_id)
+        schedule['enabled'] = bool(enabled)
+        save_schedules(schedules_registry)
+        return dict(schedule)
+
+def remove_schedules(predicate):
+    """Deletes the schedules matching predicate from the registry, the file and the scheduler."""
+    with schedules_lock:
+        removed = [s for s in schedules_registry if predicate(s)]
+        if not removed:
+            return []
+        for schedule in removed:
+            if scheduler.get_job(schedule['id']):
+                scheduler.remove_job(schedule['id'])
+        schedules_registry[:] = [s for s in schedules_registry if not predicate(s)]
+        save_schedules(schedules_registry)
+        return removed
 
 # Funzioni per lo scheduling
 def add_scheduled_job(schedule):
@@ -2739,6 +3498,7 @@ def add_scheduled_job(schedule):
     schedule_type = schedule['type']
     time_str = schedule['time']
     hour, minute = map(int, time_str.split(':'))
+    jitter = int(schedule.get('jitter', SCHEDULE_JITTER)) or None
     
     if schedule_type == 'once':
         run_date = datetime.strptime(schedule['date'], '%Y-%m-%d')
@@ -2746,26 +3506,34 @@ def add_scheduled_job(schedule):
         trigger = 'date'
         kwargs = {'run_date': run_date}
     elif schedule_type == 'daily':
-        trigger = CronTrigger(hour=hour, minute=minute)
+        trigger = CronTrigger(hour=hour, minute=minute, jitter=jitter)
     elif schedule_type == 'weekly':
         day_of_week = schedule['day_of_week']
-        trigger = CronTrigger(day_of_week=day_of_week, hour=hour, minute=minute)
+        trigger = CronTrigger(day_of_week=day_of_week, hour=hour, minute=minute, jitter=jitter)
     elif schedule_type == 'monthly':
         day = schedule['day']
-        trigger = CronTrigger(day=day, hour=hour, minute=minute)
+        trigger = CronTrigger(day=day, hour=hour, minute=minute, jitter=jitter)
     elif schedule_type == 'yearly':
         month = schedule['month']
         day = schedule['day']
-        trigger = CronTrigger(month=month, day=day, hour=hour, minute=minute)
+        trigger = CronTrigger(month=month, day=day, hour=hour, minute=minute, jitter=jitter)
     
     if trigger:
-        job_func = execute_scheduled_backup if 'switch_index' in schedule else execute_global_scheduled_backup
-        args = [schedule['switch_index']] if 'switch_index' in schedule else []
+        if 'switch_index' in schedule:
+            job_func = execute_scheduled_backup
+            args = [schedule['switch_index']]
+            job_kwargs = {}
+        else:
+            job_func = execute_global_scheduled_backup
+            args = []
+            # Gruppo di dispositivi (switch_ids) e parametri di distribuzione nel tempo, se presenti
+            job_kwargs = {key: schedule[key] for key in ('switch_ids', 'window', 'concurrency', 'dispatch_jitter') if key in schedule}
         
         scheduler.add_job(
             job_func,
             trigger,
             args=args,
+            kwargs=job_kwargs,
             id=schedule['id'],
             name=f"Backup {'switch ' + str(schedule['switch_index']) if 'switch_index' in schedule else 'globale'}",
             replace_existing=True,
@@ -2775,9 +3543,8 @@ def add_scheduled_job(schedule):
 def execute_scheduled_backup(switch_index):
     try:
         with app.app_context():
-            switches_data = load_switches()
-            if 0 <= switch_index < len(switches_data):
-                switch = switches_data[switch_index]
+            switch = get_switch(switch_index)
+            if switch:
                 logger.info(f"Esecuzione backup programmato per {switch['hostname']} ({switch['ip']})")
                 result = backup_switch({'index': switch_index, 'scheduled': True})
                 if not result.get('success', False):
@@ -2785,16 +3552,205 @@ def execute_scheduled_backup(switch_index):
     except Exception as e:
         logger.error(f"Error during the execution of the scheduled backup: {str(e)}")
 
-def execute_global_scheduled_backup():
+def stagger_offsets(switch_ids, window, jitter=None):
+    """
+    Start offsets (seconds) that spread switch_ids evenly over window seconds: device i gets slot
+    i * window / n plus a random jitter, by default up to the whole slot. Returns {switch_id: offset}.
+    """
+    switch_ids = list(switch_ids)
+    if not switch_ids:
+        return {}
+    slot = window / len(switch_ids)
+    jitter = slot if jitter is None else min(jitter, slot) if slot else jitter
+    return {switch_id: i * slot + random.uniform(0, jitter) for i, switch_id in enumerate(switch_ids)}
+
+def execute_global_scheduled_backup(switch_ids=None, window=0, concurrency=None, dispatch_jitter=None):
+    """
+    Scheduled backup of all devices, or of the switch_ids group. With a window (minutes) the starts
+    are spread over it with jitter instead of all at once; concurrency caps the parallel backups.
+    """
     try:
         with app.app_context():
-            logger.info("Global backup execution set for all devices")
             switches_data = load_switches()
-            for i in range(len(switches_data)):
-                execute_scheduled_backup(i)
+            if switch_ids is not None:
+                wanted = set(switch_ids)
+                switches_data = [switch for switch in switches_data if switch['id'] in wanted]
+            ids = [switch['id'] for switch in switches_data]
+            window_seconds = max(0, float(window or 0)) * 60
+
+            offsets = None
+            if window_seconds or dispatch_jitter:
+                offsets = stagger_offsets(ids, window_seconds, dispatch_jitter)
+                ids.sort(key=offsets.get)
+                logger.info(f"Global backup of {len(ids)} devices spread over {window or 0} minutes")
+            else:
+                logger.info("Global backup execution set for all devices")
+            results = run_parallel_backups(ids, scheduled=True, workers=concurrency, start_offsets=offsets)
+            for result in results:
+                if not result.get('success', False):
+                    logger.error(f"Error during scheduled backup: {result.get('message', 'Nessun dettaglio')}")
     except Exception as e:
         logger.error(f"Error during the global backup execution: {str(e)}")
 
+# Motore di esecuzione parallela dei backup
+def run_parallel_backups(switch_ids, scheduled=False, workers=None, on_start=None, on_result=None, start_offsets=None):
+    """
+    Runs backup_switch for many devices at once on a bounded thread pool.
+
+    Args:
+        switch_ids: Iterable of device ids to back up
+        scheduled (bool, optional): Flag forwarded to backup_switch. Default False.
+        workers (int, optional): Pool size. Default BACKUP_WORKERS.
+        on_start (callable, optional): Called with switch_id when a device backup starts
+        on_result (callable, optional): Called with (switch_id, result) when it finishes
+        start_offsets (dict, optional): Seconds after the call at which each switch_id may start
+
+    Returns:
+        list: backup_switch results, in the same order as switch_ids
+    """
+    switch_ids = list(switch_ids)
+    if not switch_ids:
+        return []
+
+    workers = max(1, min(int(workers or BACKUP_WORKERS), len(switch_ids), BACKUP_WORKERS_MAX))
+    dispatch_started = time.monotonic()
+
+    def run_one(switch_id):
+        if start_offsets:
+            delay = dispatch_started + start_offsets.get(switch_id, 0) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if on_start:
+            on_start(switch_id)
+        try:
+            result = backup_switch({'id': switch_id, 'scheduled': scheduled})
+        except Exception as e:
+            logger.error(f"Error during the backup of device {switch_id}: {str(e)}")
+            result = {
+                'success': False,
+                'message': f"Unexpected error: {str(e)}",
+                'error_type': 'UnexpectedError'
+            }
+        if on_result:
+            on_result(switch_id, result)
+        return result
+
+    logger.info(f"Running {len(switch_ids)} backups with {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup') as executor:
+        return list(executor.map(run_one, switch_ids))
+
+# Sottosistema dei job di backup asincroni
+# I job girano su un executor dedicato, separato dai thread delle richieste Flask
+backup_jobs = {}
+backup_jobs_lock = threading.Lock()
+job_executor = ThreadPoolExecutor(max_workers=BACKUP_JOB_SLOTS, thread_name_prefix='backup-job')
+atexit.register(lambda: job_executor.shutdown(wait=False))
+
+def _prune_backup_jobs():
+    limit = time.time() - BACKUP_JOB_RETENTION
+    for job_id in [j['id'] for j in backup_jobs.values() if j['finished_ts'] and j['finished_ts'] < limit]:
+        del backup_jobs[job_id]
+
+def publish_job_event(job):
+    """Live progress of a job for the dashboards, with the counters of get_backup_job()."""
+    with backup_jobs_lock:
+        progress = {key: job[key] for key in ('status', 'message', 'done', 'count', 'total')}
+    publish_event('backup_job', job_id=job['id'], **progress)
+
+def submit_backup_job(switches, workers=None):
+    """
+    Queues a backup of the given devices and returns the job id immediately.
+    Progress is tracked per device in backup_jobs and exposed by get_backup_job().
+    """
+    job_id = f"job_{int(time.time())}_{os.urandom(4).hex()}"
+    job = {
+        'id': job_id,
+        'status': 'queued',
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'started_at': None,
+        'finished_at': None,
+        'finished_ts': None,
+        'total': len(switches),
+        'done': 0,
+        'count': 0,
+        'devices': {
+            switch['id']: {
+                'hostname': switch['hostname'],
+                'ip': switch['ip'],
+                'status': 'pending',
+                'message': '',
+                'filename': ''
+            } for switch in switches
+        },
+        'order': [switch['id'] for switch in switches],
+        'message': ''
+    }
+    with backup_jobs_lock:
+        _prune_backup_jobs()
+        backup_jobs[job_id] = job
+
+    def on_start(switch_id):
+        with backup_jobs_lock:
+            job['devices'][switch_id]['status'] = 'running'
+
+    def on_result(switch_id, result):
+        with backup_jobs_lock:
+            device = job['devices'][switch_id]
+            device['status'] = 'success' if result.get('success', False) else 'failed'
+            device['message'] = result.get('message', '')
+            device['filename'] = result.get('filename', '')
+            job['done'] += 1
+            job['count'] += 1 if result.get('success', False) else 0
+        publish_job_event(job)
+
+    def run_job():
+        with backup_jobs_lock:
+            job['status'] = 'running'
+            job['started_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        publish_job_event(job)
+        try:
+            run_parallel_backups(job['order'], workers=workers, on_start=on_start, on_result=on_result)
+            status = 'completed'
+            logger.info(f"Backup job {job_id} completed. Success: {job['count']}/{job['total']}")
+        except Exception as e:
+            status = 'failed'
+            job['message'] = str(e)
+            logger.error(f"Backup job {job_id} failed: {str(e)}")
+        with backup_jobs_lock:
+            job['status'] = status
+            job['finished_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            job['finished_ts'] = time.time()
+        publish_job_event(job)
+
+    job_executor.submit(run_job)
+    logger.info(f"Queued backup job {job_id} for {len(switches)} devices")
+    return job_id
+
+def get_backup_job(job_id):
+    """Returns a JSON-ready snapshot of a job, with results in the same shape as /backup_all_switches."""
+    with backup_jobs_lock:
+        job = backup_jobs.get(job_id)
+        if not job:
+            return None
+        results = [{
+            'id': switch_id,
+            'success': job['devices'][switch_id]['status'] == 'success',
+            **job['devices'][switch_id]
+        } for switch_id in job['order']]
+        return {
+            'success': True,
+            'job_id': job['id'],
+            'status': job['status'],
+            'message': job['message'],
+            'created_at': job['created_at'],
+            'started_at': job['started_at'],
+            'finished_at': job['finished_at'],
+            'done': job['done'],
+            'count': job['count'],
+            'total': job['total'],
+            'results': results
+        }
+
 # Funzioni di utilità
 def is_logged_in():
     return session.get('logged_in')
@@ -3094,9 +4050,7 @@ def add_switch():
         'last_backup_time': None
     }
     
-    switches_data = load_switches()
-    switches_data.append(switch_data)
-    save_switches(switches_data)
+    insert_switch(switch_data)
     
     logger.info(f"Added device: {data['hostname']} ({data['ip']})")
     return jsonify({'success': True, 'message': 'Device added successfully'})
@@ -3114,27 +4068,25 @@ def update_switch():
     if 'index' not in data:
         return jsonify({'success': False, 'message': 'Missing index'})
     
-    switches_data = load_switches()
-    index = int(data['index'])
+    switch = get_switch(int(data['index']))
     
-    if 0 <= index < len(switches_data):
-        old_hostname = switches_data[index]['hostname']
+    if switch:
+        old_hostname = switch['hostname']
         
         # Keep existing passwords if not provided, otherwise encrypt new ones
-        password = encrypt_password(data['password']) if 'password' in data and data['password'] else switches_data[index]['password']
+        password = encrypt_password(data['password']) if 'password' in data and data['password'] else switch['password']
         # For enable_password, use the new password if provided, otherwise keep existing enable_password
         enable_password = encrypt_password(data['enable_password']) if 'enable_password' in data and data['enable_password'] else password
         
-        switches_data[index] = {
+        update_switch_row(switch['id'], {
             'hostname': data['hostname'],
             'ip': data['ip'],
             'username': data['username'],
             'password': password,
             'enable_password': enable_password,
-            'device_type': data.get('device_type', switches_data[index].get('device_type', 'cisco_ios'))
-        }
+            'device_type': data.get('device_type', switch.get('device_type') or 'cisco_ios')
+        })
         
-        save_switches(switches_data)
         logger.info(f"Aggiornato switch: da {old_hostname} a {data['hostname']} ({data['ip']})")
         return jsonify({'success': True, 'message': 'Device updated'})
     else:
@@ -3147,16 +4099,13 @@ def delete_switch():
     if 'index' not in data:
         return jsonify({'success': False, 'message': 'Missing index'})
     
-    switches_data = load_switches()
     index = int(data['index'])
+    deleted_switch = get_switch(index)
     
-    if 0 <= index < len(switches_data):
-        deleted_switch = switches_data.pop(index)
-        save_switches(switches_data)
+    if deleted_switch:
+        delete_switch_row(deleted_switch['id'])
         
-        schedules_data = load_schedules()
-        schedules_data = [s for s in schedules_data if s.get('switch_index') != index]
-        save_schedules(schedules_data)
+        remove_schedules(lambda s: s.get('switch_index') == index)
         
         logger.info(f"Eliminato switch: {deleted_switch['hostname']} ({deleted_switch['ip']})")
         return jsonify({'success': True, 'message': 'Switch eliminato'})
@@ -3172,6 +4121,13 @@ def backup_switch_http():
         if not data:
             return jsonify({'success': False, 'message': 'Invalid request data'})
             
+        if data.get('async'):
+            switch = get_switch_by_id(int(data['id'])) if 'id' in data else get_switch(int(data.get('index', -1)))
+            if not switch:
+                return jsonify({'success': False, 'message': 'Invalid switch index', 'error_type': 'IndexError'})
+            job_id = submit_backup_job([switch])
+            return jsonify({'success': True, 'message': 'Backup queued', 'job_id': job_id}), 202
+
         result = backup_switch(data)
         return jsonify(result)
         
@@ -3191,18 +4147,12 @@ def delete_backup():
         return jsonify({'success': False, 'message': 'File path missing'}), 400
 
     try:
-        filepath = data['filepath']
-        # Normalizza il percorso per sicurezza
-        filepath = os.path.normpath(filepath)
-        backup_dir = os.path.abspath(BACKUP_DIR)
-        requested_path = os.path.abspath(os.path.join(backup_dir, filepath))
-        
-        # Verifica che il percorso sia dentro la directory dei backup
-        if not requested_path.startswith(backup_dir + os.sep):
+        # Solo versioni logiche: i blob in .store sono condivisi da altre versioni
+        requested_path = resolve_backup_path(data['filepath'])
+        if not requested_path:
             return jsonify({'success': False, 'message': 'Invalid file path'}), 403
         
-        if os.path.isfile(requested_path):
-            os.remove(requested_path)
+        if version_exists(requested_path) and delete_version(requested_path):
             logger.info(f"Deleted backup file: {requested_path}")
             return jsonify({'success': True, 'message': 'Backup deleted'})
         else:
@@ -3212,6 +4162,1337 @@ def delete_backup():
         logger.error(f"Error deleting backup: {str(e)}")
         return jsonify({'success': False, 'message': str(e)}), 500
         
+# Profili di backup per device_type netmiko
+# Ogni profilo definisce comandi di paginazione, comando di recupero, marker di fine output,
+# regole di pulizia e budget di timeout (secondi) per fase della sessione interattiva
+DEFAULT_BACKUP_PROFILE = {
+    'enable': True,
+    'paging_commands': ['terminal length 0', 'terminal width 512'],
+    'config_command': 'show running-config',
+    'end_markers': [r'(?:^|\n)end\r?\n\s*$'],
+    'trim_head': 5,
+    'trim_prompt': True,
+    'min_lines': 20,
+    'timeouts': {'prompt': 15, 'paging': 10, 'config': 60},
+}
+
+BACKUP_PROFILES = {
+    'cisco_ios': {},
+    'cisco_xe': {},
+    'cisco_xr': {'trim_head': 3},
+    'cisco_nxos': {'paging_commands': ['terminal length 0', 'terminal width 511'], 'trim_head': 3},
+    'cisco_asa': {'paging_commands': ['terminal pager 0'], 'end_markers': [r'(?:^|\n): end\r?\n\s*$']},
+    'arista_eos': {'paging_commands': ['terminal length 0', 'terminal width 32767'], 'trim_head': 1},
+    'juniper_junos': {
+        'enable': False,
+        'paging_commands': ['set cli screen-length 0', 'set cli screen-width 0'],
+        'config_command': 'show configuration | display set',
+        'end_markers': [],
+        'trim_head': 1,
+        'min_lines': 10,
+    },
+    'hp_procurve': {'paging_commands': ['no page'], 'end_markers': [], 'trim_head': 1},
+    'hp_comware': {
+        'enable': False,
+        'paging_commands': ['screen-length disable'],
+        'config_command': 'display current-configuration',
+        'end_markers': [r'(?:^|\n)return\r?\n\s*$'],
+        'trim_head': 1,
+    },
+    'huawei': {
+        'enable': False,
+        'paging_commands': ['screen-length 0 temporary'],
+        'config_command': 'display current-configuration',
+        'end_markers': [r'(?:^|\n)return\r?\n\s*$'],
+        'trim_head': 1,
+    },
+    'mikrotik_routeros': {
+        'enable': False,
+        'paging_commands': [],
+        'config_command': '/export',
+        'end_markers': [],
+        'trim_head': 1,
+        'min_lines': 10,
+    },
+    'fortinet': {
+        'enable': False,
+        'paging_commands': [],
+        'config_command': 'show',
+        'end_markers': [],
+        'trim_head': 1,
+        'timeouts': {'prompt': 15, 'paging': 10, 'config': 120},
+    },
+}
+
+@lru_cache(maxsize=1)
+def load_backup_profiles():
+    """Built-in profiles merged with the optional BACKUP_PROFILES_FILE, read once per process."""
+    profiles = {name: dict(profile) for name, profile in BACKUP_PROFILES.items()}
+    if os.path.exists(BACKUP_PROFILES_FILE):
+        try:
+            with open(BACKUP_PROFILES_FILE, 'r', encoding='utf-8') as f:
+                for name, profile in json.load(f).items():
+                    profiles[name] = {**profiles.get(name, {}), **profile}
+            logger.info(f"Loaded backup profiles from {BACKUP_PROFILES_FILE}")
+        except (json.JSONDecodeError, OSError, AttributeError) as e:
+            logger.error(f"Invalid backup profiles file, using built-in profiles: {str(e)}")
+    return profiles
+
+@lru_cache(maxsize=None)
+def get_backup_profile(device_type):
+    """Returns the backup profile for a netmiko device_type ('_ssh'/'_telnet' suffixes ignored)."""
+    profiles = load_backup_profiles()
+    base_type = re.sub(r'_(ssh|telnet|serial)$', '', device_type or '')
+    overrides = profiles.get(device_type, profiles.get(base_type, {}))
+
+    profile = {**DEFAULT_BACKUP_PROFILE, **overrides}
+    profile['timeouts'] = {**DEFAULT_BACKUP_PROFILE['timeouts'], **overrides.get('timeouts', {})}
+    profile['end_re'] = re.compile('|'.join(f'(?:{m})' for m in profile['end_markers'])) if profile['end_markers'] else None
+    return profile
+
+# Archivio dei backup indirizzato per contenuto
+# Ogni configurazione distinta è salvata una sola volta in .store/objects/<hash[:2]>/<hash>;
+# ogni versione di un dispositivo è un file <nome>.txt.ref in backups/<hostname>/ che contiene
+# l'hash del proprio blob. Il percorso logico di una versione resta backups/<hostname>/<nome>.txt
+VERSION_REF_SUFFIX = '.ref'
+
+# Estensione dei blob per formato di compressione
+OBJECT_CODECS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+def get_store_codec():
+    if STORE_COMPRESSION not in OBJECT_CODECS:
+        logger.warning(f"Unknown store compression '{STORE_COMPRESSION}', using gzip")
+        return 'gzip'
+    if STORE_COMPRESSION == 'zstd' and zstandard is None:
+        logger.warning("zstandard module not installed, using gzip compression")
+        return 'gzip'
+    return STORE_COMPRESSION
+
+def object_path(digest, codec='none', delta=False):
+    return os.path.join(STORE_OBJECTS_DIR, digest[:2], digest + ('.delta' if delta else '') + OBJECT_CODECS[codec])
+
+def _object_candidates(digest):
+    for delta in (False, True):
+        for codec in OBJECT_CODECS:
+            yield object_path(digest, codec, delta), codec, delta
+
+def find_object(digest):
+    """Returns (path, codec, is_delta) of a stored blob, whatever format it was written in, or (None, None, None)."""
+    for path, codec, delta in _object_candidates(digest):
+        if os.path.exists(path):
+            return path, codec, delta
+    return None, None, None
+
+def compress_to_temp(source_path, codec):
+    """Writes source_path in the given codec to a new file in the store tmp directory and returns its path."""
+    fd, temp_path = tempfile.mkstemp(prefix='blob_', suffix='.part', dir=STORE_TMP_DIR)
+    try:
+        with open(source_path, 'rb') as src, os.fdopen(fd, 'wb') as raw:
+            if codec == 'gzip':
+                with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6, mtime=0) as dst:
+                    shutil.copyfileobj(src, dst)
+            elif codec == 'zstd':
+                zstandard.ZstdCompressor(level=10).copy_stream(src, raw)
+            else:
+                shutil.copyfileobj(src, raw)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return temp_path
+
+def compress_file(source_path, target_path, codec):
+    """Writes source_path to target_path in the given codec, atomically."""
+    temp_path = compress_to_temp(source_path, codec)
+    try:
+        os.replace(temp_path, target_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+def _open_codec(path, codec):
+    if codec == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard module required to read zstd-compressed backups")
+        raw = open(path, 'rb')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True), encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+def _read_delta_record(digest):
+    path, codec, delta = find_object(digest)
+    if not delta:
+        return None
+    with _open_codec(path, codec) as f:
+        return json.load(f)
+
+def object_depth(digest):
+    """Number of deltas applied to rebuild a blob (0 for a keyframe)."""
+    record = _read_delta_record(digest)
+    return record['depth'] if record else 0
+
+# Righe modificate oltre questa soglia (dopo aver escluso prefisso e suffisso comuni): keyframe completo.
+# SequenceMatcher è quadratico nel caso peggiore, la soglia limita il tempo speso da un singolo backup
+DELTA_DIFF_MAX_LINES = 2000
+
+def _line_hash(line):
+    return int.from_bytes(hashlib.blake2b(line.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def iter_lines(f):
+    """Lines of a text stream without their newline, exactly as f.read().split('\\n') would return them."""
+    ended = True
+    for line in f:
+        ended = line.endswith('\n')
+        yield line[:-1] if ended else line
+    if ended:
+        yield ''
+
+def _apply_ops(base_lines, ops):
+    """Streams the lines of a delta applied to an iterator over its base ('=' ranges are ascending)."""
+    position = 0
+    for op in ops:
+        if op[0] == '=':
+            for line in base_lines:
+                if position >= op[1]:
+                    break
+                position += 1
+            else:
+                raise ValueError("Delta references lines beyond its base")
+            yield line
+            position += 1
+            while position < op[2]:
+                yield next(base_lines)
+                position += 1
+        else:
+            yield from op[1:]
+
+class LineStreamReader(io.TextIOBase):
+    """Read-only text stream over a line iterator (lines joined by newlines); closing it closes source."""
+
+    def __init__(self, lines, source):
+        super().__init__()
+        self._chunks = self._join(lines)
+        self._buffer = ''
+        self._source = source
+
+    @staticmethod
+    def _join(lines):
+        first = True
+        for line in lines:
+            yield line if first else '\n' + line
+            first = False
+
+    def readable(self):
+        return True
+
+    def _fill(self, size=-1, line=False):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            # Ogni frammento dopo il primo inizia con '\n': la riga in corso si chiude lì
+            if line and '\n' in parts[-1]:
+                break
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        self._buffer = ''.join(parts)
+
+    def read(self, size=-1):
+        size = -1 if size is None else size
+        self._fill(size)
+        end = len(self._buffer) if size < 0 else size
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def readline(self, size=-1):
+        size = -1 if size is None else size
+        self._fill(size, line=True)
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def close(self):
+        if not self.closed:
+            self._source.close()
+        super().close()
+
+def build_delta(base_digest, temp_path):
+    """
+    Line delta from base_digest to the content of temp_path, or None when a keyframe is cheaper.
+    Both sides are compared as arrays of 64-bit line hashes (a collision is caught by verify_delta);
+    only the region between the common prefix and suffix goes through SequenceMatcher, and only the
+    added lines are read back as text.
+    """
+    size = os.path.getsize(temp_path)
+    if size > STORE_DELTA_MAX_BYTES:
+        return None
+    with open_object(base_digest) as f:
+        base = array('Q', map(_line_hash, iter_lines(f)))
+    with open(temp_path, 'r', encoding='utf-8') as f:
+        new = array('Q', map(_line_hash, iter_lines(f)))
+
+    prefix = 0
+    limit = min(len(base), len(new))
+    while prefix < limit and base[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and base[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    base_middle = base[prefix:len(base) - suffix]
+    new_middle = new[prefix:len(new) - suffix]
+    if len(base_middle) > DELTA_DIFF_MAX_LINES or len(new_middle) > DELTA_DIFF_MAX_LINES:
+        return None
+
+    ops, added = [], []
+    if prefix:
+        ops.append(['=', 0, prefix])
+    matcher = difflib.SequenceMatcher(None, base_middle.tolist(), new_middle.tolist(), autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(['=', prefix + i1, prefix + i2])
+        elif tag in ('replace', 'insert'):
+            ops.append(['+'])
+            added.append((ops[-1], prefix + j1, prefix + j2))
+    if suffix:
+        ops.append(['=', len(base) - suffix, len(base)])
+
+    # Seconda lettura del nuovo file, per copiare nel delta solo le righe aggiunte
+    if added:
+        pending = iter(added)
+        op, start, stop = next(pending)
+        with open(temp_path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(iter_lines(f)):
+                while op is not None and number >= stop:
+                    op, start, stop = next(pending, (None, 0, 0))
+                if op is None:
+                    break
+                if number >= start:
+                    op.append(line)
+    record = {'base': base_digest, 'depth': object_depth(base_digest) + 1, 'ops': ops}
+
+    if len(json.dumps(record)) > size // 2:
+        return None
+    return record
+
+def verify_delta(record, digest):
+    """True when applying record to its base rebuilds exactly the content with the given sha256."""
+    content_hash = hashlib.sha256()
+    with open_object(record['base']) as f:
+        for n, line in enumerate(_apply_ops(iter_lines(f), record['ops'])):
+            content_hash.update((line if n == 0 else '\n' + line).encode('utf-8'))
+    return content_hash.hexdigest() == digest
+
+def prepare_object_file(temp_path, digest, base_digest=None):
+    """
+    Builds the file a capture will be stored as, without touching the store: returns
+    (prepared_path, target_path, delta_base). When base_digest is given and the chain is short
+    enough, a line delta is prepared instead of a keyframe. temp_path itself is left in place
+    (it is the prepared file for uncompressed keyframes).
+    """
+    codec = get_store_codec()
+    if STORE_DELTA_CHAIN and base_digest and find_object(base_digest)[0] and object_depth(base_digest) < STORE_DELTA_CHAIN:
+        try:
+            record = build_delta(base_digest, temp_path)
+            if record and not verify_delta(record, digest):
+                logger.warning(f"Delta of {digest} against {base_digest} does not rebuild the content, storing a keyframe")
+                record = None
+        except FileNotFoundError:
+            # La base è stata raccolta mentre la si leggeva
+            record = None
+        if record:
+            fd, delta_temp = tempfile.mkstemp(prefix='delta_', suffix='.part', dir=STORE_TMP_DIR)
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(record, f, separators=(',', ':'))
+                return compress_to_temp(delta_temp, codec), object_path(digest, codec, delta=True), base_digest
+            finally:
+                os.remove(delta_temp)
+
+    if codec == 'none':
+        return temp_path, object_path(digest), None
+    return compress_to_temp(temp_path, codec), object_path(digest, codec), None
+
+def install_object_file(prepared, digest):
+    """
+    Moves a prepared blob into the store; called with store_gc_lock held, so it only renames and
+    records the delta base. Returns False when the store lacks digest and prepared cannot be used
+    (nothing prepared, or its delta base was collected in the meantime).
+    """
+    if find_object(digest)[0]:
+        return True
+    if prepared is None:
+        return False
+    prepared_path, target_path, base_digest = prepared
+    if base_digest and not find_object(base_digest)[0]:
+        return False
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    os.replace(prepared_path, target_path)
+    if base_digest:
+        conn = get_db()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO store_deltas (digest, base) VALUES (?, ?)', (digest, base_digest))
+    return True
+
+def open_object(digest):
+    """
+    Opens a blob as decompressed text. A delta is rebuilt as a stream: its chain of records is read
+    first, then the keyframe lines flow through each record's ops in turn, with a single file open.
+    """
+    records = []
+    current = digest
+    while True:
+        for path, codec, delta in _object_candidates(current):
+            try:
+                f = _open_codec(path, codec)
+            except FileNotFoundError:
+                # Il convertitore in background può aver appena ricompresso il blob: prova il formato successivo
+                continue
+            break
+        else:
+            raise FileNotFoundError(f"Backup object {current} not found")
+        if not delta:
+            break
+        with f:
+            record = json.load(f)
+        records.append(record)
+        if len(records) > max(STORE_DELTA_CHAIN, 64):
+            raise ValueError(f"Delta chain of {digest} is too long")
+        current = record['base']
+
+    if not records:
+        return f
+    lines = iter_lines(f)
+    for record in reversed(records):
+        lines = _apply_ops(lines, record['ops'])
+    return LineStreamReader(lines, f)
+
+def convert_store_objects():
+    """Background converter: rewrites blobs stored in another format with the configured compression."""
+    codec = get_store_codec()
+    converted = 0
+    for prefix in sorted(os.listdir(STORE_OBJECTS_DIR)):
+        prefix_dir = os.path.join(STORE_OBJECTS_DIR, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for filename in os.listdir(prefix_dir):
+            digest, _, ext = filename.partition('.')
+            # I delta restano nel formato con cui sono stati scritti
+            current = next((c for c, e in OBJECT_CODECS.items() if e == ('.' + ext if ext else '')), None)
+            if current is None or current == codec:
+                continue
+            source_path = os.path.join(prefix_dir, filename)
+            try:
+                if current == 'none':
+                    compress_file(source_path, object_path(digest, codec), codec)
+                else:
+                    with open_object(digest) as src, tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=STORE_TMP_DIR, delete=False) as tmp:
+                        shutil.copyfileobj(src, tmp)
+                    compress_file(tmp.name, object_path(digest, codec), codec)
+                    os.remove(tmp.name)
+                os.remove(source_path)
+                converted += 1
+            except Exception as e:
+                logger.error(f"Unable to convert backup object {filename}: {str(e)}")
+            time.sleep(0.01)  # Limita il carico di I/O sulla scheda SD
+    if converted:
+        logger.info(f"Backup store conversion completed: {converted} objects rewritten as {codec}")
+
+def store_maintenance():
+    migrate_backups_to_store()
+    build_backup_catalog()
+    build_search_index()
+    convert_store_objects()
+
+def write_version_ref(version_path, digest):
+    fd, temp_path = tempfile.mkstemp(prefix='ref_', suffix='.part', dir=STORE_TMP_DIR)
+    with os.fdopen(fd, 'w') as f:
+        f.write(digest + '\n')
+    os.replace(temp_path, version_path + VERSION_REF_SUFFIX)
+
+def read_version_ref(version_path):
+    try:
+        with open(version_path + VERSION_REF_SUFFIX, 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def version_exists(version_path):
+    return os.path.isfile(version_path + VERSION_REF_SUFFIX) or os.path.isfile(version_path)
+
+def open_version(version_path):
+    """Opens a stored version for reading as text, whether it is a store reference or a legacy plain file."""
+    digest = read_version_ref(version_path)
+    return open_object(digest) if digest else open(version_path, 'r', encoding='utf-8')
+
+def read_version(version_path):
+    with open_version(version_path) as f:
+        return f.read()
+
+def delete_version(version_path):
+    """Removes a version entry; its blob stays in the store while other versions may reference it."""
+    removed = False
+    for path in (version_path + VERSION_REF_SUFFIX, version_path):
+        if os.path.isfile(path):
+            os.remove(path)
+            removed = True
+    catalog_remove_version(version_path)
+    search_remove_version(version_path)
+    return removed
+
+def list_versions(switch_folder):
+    """Logical file names of the versions in a device folder, newest first."""
+    if not os.path.isdir(switch_folder):
+        return []
+    names = set()
+    for filename in os.listdir(switch_folder):
+        if filename.endswith('.txt' + VERSION_REF_SUFFIX):
+            names.add(filename[:-len(VERSION_REF_SUFFIX)])
+        elif filename.endswith('.txt'):
+            names.add(filename)
+    return sorted(names, reverse=True)
+
+def latest_version_digest(switch_folder):
+    """Blob hash of the newest stored version in a device folder, if any."""
+    if catalog_ready():
+        latest = catalog_latest(os.path.basename(switch_folder))
+        return latest['content_hash'] if latest else None
+    for filename in list_versions(switch_folder):
+        digest = read_version_ref(os.path.join(switch_folder, filename))
+        if digest:
+            return digest
+    return None
+
+def migrate_backups_to_store():
+    """One-time conversion of the legacy backups/<hostname>/*.txt tree into store references."""
+    if os.path.exists(STORE_MIGRATED_MARKER):
+        return
+    migrated = 0
+    try:
+        for folder in sorted(os.listdir(BACKUP_DIR)):
+            switch_folder = os.path.join(BACKUP_DIR, folder)
+            if folder.startswith('.') or not os.path.isdir(switch_folder):
+                continue
+            # I file sono in ordine cronologico: la versione precedente fa da base del delta senza riscandire la cartella
+            previous_digest = None
+            for filename in sorted(os.listdir(switch_folder)):
+                version_path = os.path.join(switch_folder, filename)
+                if not filename.endswith('.txt') or os.path.exists(version_path + VERSION_REF_SUFFIX):
+                    continue
+                capture = ConfigCapture()
+                try:
+                    with open(version_path, 'r', encoding='utf-8', errors='replace') as f:
+                        for chunk in iter(lambda: f.read(65536), ''):
+                            capture.write(chunk)
+                    previous_digest = capture.commit(version_path, method='migrated', base_digest=previous_digest)
+                    os.remove(version_path)
+                except Exception as e:
+                    # Il file resta una versione legacy leggibile; la migrazione prosegue con gli altri
+                    capture.discard()
+                    logger.error(f"Unable to migrate backup {version_path}, left as a plain file: {str(e)}")
+                    continue
+                migrated += 1
+        with open(STORE_MIGRATED_MARKER, 'w') as f:
+            f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S') + '\n')
+        logger.info(f"Backup store migration completed: {migrated} files converted")
+    except Exception as e:
+        logger.error(f"Backup store migration interrupted after {migrated} files: {str(e)}")
+
+# Catalogo delle versioni (indice SQLite aggiornato a ogni scrittura di backup)
+CATALOG_FIELDS = ['folder', 'filename', 'created_at', 'size', 'line_count', 'content_hash', 'method', 'duration']
+
+def _version_timestamp(filename, fallback_path=None):
+    match = re.search(r'_(\d{8}_\d{6})\.txt$', filename)
+    if match:
+        return datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+    mtime = os.path.getmtime(fallback_path) if fallback_path and os.path.exists(fallback_path) else time.time()
+    return datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+
+def catalog_add_version(version_path, digest, size, line_count, method=None, duration=None):
+    folder, filename = os.path.basename(os.path.dirname(version_path)), os.path.basename(version_path)
+    conn = get_db()
+    with conn:
+        conn.execute(
+            f"INSERT OR REPLACE INTO backup_catalog ({', '.join(CATALOG_FIELDS)}) VALUES ({', '.join('?' * len(CATALOG_FIELDS))})",
+            (folder, filename, _version_timestamp(filename, version_path + VERSION_REF_SUFFIX),
+             size, line_count, digest, method, round(duration, 3) if duration is not None else None)
+        )
+
+def catalog_remove_version(version_path):
+    conn = get_db()
+    with conn:
+        conn.execute('DELETE FROM backup_catalog WHERE folder = ? AND filename = ?',
+                     (os.path.basename(os.path.dirname(version_path)), os.path.basename(version_path)))
+
+def catalog_ready():
+    return os.path.exists(STORE_CATALOG_MARKER)
+
+def catalog_latest(folder):
+    row = get_db().execute(
+        'SELECT * FROM backup_catalog WHERE folder = ? ORDER BY filename DESC LIMIT 1', (folder,)
+    ).fetchone()
+    return dict(row) if row else None
+
+def catalog_list_versions(folder, limit=None, before=None):
+    """Versions of a device folder, newest first; 'before' is the filename cursor of the previous page."""
+    query = 'SELECT * FROM backup_catalog WHERE folder = ?'
+    args = [folder]
+    if before:
+        query += ' AND filename < ?'
+        args.append(before)
+    query += ' ORDER BY filename DESC'
+    if limit:
+        query += ' LIMIT ?'
+        args.append(int(limit))
+    return [dict(row) for row in get_db().execute(query, args)]
+
+def build_backup_catalog():
+    """One-time indexing of the versions that were stored before the catalog existed."""
+    if catalog_ready():
+        return
+    indexed = 0
+    try:
+        conn = get_db()
+        for folder in sorted(os.listdir(BACKUP_DIR)):
+            switch_folder = os.path.join(BACKUP_DIR, folder)
+            if folder.startswith('.') or not os.path.isdir(switch_folder):
+                continue
+            known = {row[0] for row in conn.execute('SELECT filename FROM backup_catalog WHERE folder = ?', (folder,))}
+            for filename in list_versions(switch_folder):
+                if filename in known:
+                    continue
+                version_path = os.path.join(switch_folder, filename)
+                digest = read_version_ref(version_path)
+                content = read_version(version_path)
+                if not digest:
+                    digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+                catalog_add_version(version_path, digest, len(content.encode('utf-8')), len(content.splitlines()))
+                indexed += 1
+        with open(STORE_CATALOG_MARKER, 'w') as f:
+            f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S') + '\n')
+        logger.info(f"Backup catalog built: {indexed} versions indexed")
+    except Exception as e:
+        logger.error(f"Backup catalog build interrupted after {indexed} versions: {str(e)}")
+
+# Indice di ricerca full-text sulle configurazioni salvate
+SEARCH_MAX_RESULTS = 500
+
+def _search_has_fts(conn):
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'search_lines'").fetchone()
+    return bool(row and 'fts5' in row[0].lower())
+
+def _search_drop_unreferenced(conn, digests):
+    for digest in digests:
+        if conn.execute('SELECT 1 FROM search_versions WHERE content_hash = ? LIMIT 1', (digest,)).fetchone():
+            continue
+        row = conn.execute('SELECT first_rowid, last_rowid FROM search_blobs WHERE content_hash = ?', (digest,)).fetchone()
+        if row:
+            conn.execute('DELETE FROM search_lines WHERE rowid BETWEEN ? AND ?', (row[0], row[1]))
+        conn.execute('DELETE FROM search_blobs WHERE content_hash = ?', (digest,))
+
+def search_index_version(version_path, digest):
+    """Makes a stored version searchable; the lines of a given content are indexed only once."""
+    folder, filename = os.path.basename(os.path.dirname(version_path)), os.path.basename(version_path)
+    try:
+        conn = get_db()
+        with conn:
+            replaced = []
+            if not SEARCH_ALL_VERSIONS:
+                replaced = [row[0] for row in conn.execute(
+                    'SELECT content_hash FROM search_versions WHERE folder = ?', (folder,))]
+                conn.execute('DELETE FROM search_versions WHERE folder = ?', (folder,))
+            conn.execute('INSERT OR REPLACE INTO search_versions (folder, filename, content_hash) VALUES (?, ?, ?)',
+                         (folder, filename, digest))
+            if conn.execute('INSERT OR IGNORE INTO search_blobs (content_hash) VALUES (?)', (digest,)).rowcount:
+                # Il lock di scrittura è già preso: le righe ricevono rowid consecutivi dopo il massimo attuale
+                first = conn.execute('SELECT COALESCE(MAX(rowid), 0) + 1 FROM search_lines').fetchone()[0]
+                with open_version(version_path) as f:
+                    rows = ((line, digest, n) for n, line in enumerate(iter_lines(f), 1) if line.strip() and line.strip() != '!')
+                    inserted = conn.executemany(
+                        'INSERT INTO search_lines (rowid, text, content_hash, line_no) VALUES (?, ?, ?, ?)',
+                        ((first + i,) + row for i, row in enumerate(rows))
+                    ).rowcount
+                conn.execute('UPDATE search_blobs SET first_rowid = ?, last_rowid = ? WHERE content_hash = ?',
+                             (first, first + inserted - 1, digest))
+            _search_drop_unreferenced(conn, set(replaced) - {digest})
+    except Exception as e:
+        logger.error(f"Unable to index {version_path} for search: {str(e)}")
+
+def search_remove_version(version_path):
+    folder, filename = os.path.basename(os.path.dirname(version_path)), os.path.basename(version_path)
+    try:
+        conn = get_db()
+        with conn:
+            row = conn.execute('SELECT content_hash FROM search_versions WHERE folder = ? AND filename = ?',
+                               (folder, filename)).fetchone()
+            if not row:
+                return
+            conn.execute('DELETE FROM search_versions WHERE folder = ? AND filename = ?', (folder, filename))
+            _search_drop_unreferenced(conn, {row[0]})
+        # Con il solo indice dell'ultima versione, la precedente diventa ricercabile
+        if not SEARCH_ALL_VERSIONS:
+            latest = catalog_latest(folder)
+            if latest:
+                search_index_version(os.path.join(BACKUP_DIR, folder, latest['filename']), latest['content_hash'])
+    except Exception as e:
+        logger.error(f"Unable to remove {version_path} from search index: {str(e)}")
+
+def build_search_index():
+    """One-time indexing of the versions already in the catalog."""
+    if os.path.exists(STORE_SEARCH_MARKER) or not catalog_ready():
+        return
+    indexed = 0
+    conn = get_db()
+    if SEARCH_ALL_VERSIONS:
+        entries = conn.execute('SELECT folder, filename, content_hash FROM backup_catalog ORDER BY folder, filename').fetchall()
+    else:
+        entries = conn.execute(
+            'SELECT folder, MAX(filename) AS filename, content_hash FROM backup_catalog GROUP BY folder'
+        ).fetchall()
+    for entry in entries:
+        search_index_version(os.path.join(BACKUP_DIR, entry['folder'], entry['filename']), entry['content_hash'])
+        indexed += 1
+    with open(STORE_SEARCH_MARKER, 'w') as f:
+        f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S') + '\n')
+    logger.info(f"Search index built: {indexed} versions indexed")
+
+def search_configs(text, limit=SEARCH_MAX_RESULTS):
+    """Lines containing text (case-insensitive) in the indexed versions, as dicts with folder, filename, line_no, text."""
+    conn = get_db()
+    needle = text.lower()
+    query = ('SELECT v.folder, v.filename, l.line_no, l.text FROM search_lines l '
+             'JOIN search_versions v ON v.content_hash = l.content_hash WHERE ')
+    if _search_has_fts(conn) and len(text) >= 3:
+        # Frase trigram per trovare i candidati, poi verifica della sottostringa esatta
+        query += 'search_lines MATCH ?'
+        args = ['text: "' + text.replace('"', '""') + '"']
+    else:
+        query += "l.text LIKE ? ESCAPE '\\'"
+        args = ['%' + re.sub(r'([%_\\])', r'\\\1', text) + '%']
+    query += ' ORDER BY v.folder, v.filename DESC, l.line_no'
+
+    results = []
+    for row in conn.execute(query, args):
+        if needle in row['text'].lower():
+            results.append(dict(row))
+            if len(results) >= limit:
+                break
+    return results
+
+# Conservazione dei backup (grandfather-father-son) e garbage collection dei blob
+# Esempio di retention.json: tutte le versioni per 7 giorni, una al giorno fino a 30 giorni,
+# una a settimana fino a 52 settimane, una al mese per sempre (null = senza limite, 0 = nessuna)
+# {"enabled": true, "keep_all_days": 7, "daily_days": 30, "weekly_weeks": 52, "monthly_months": null}
+DEFAULT_RETENTION_POLICY = {
+    'enabled': False,
+    'keep_all_days': 7,
+    'daily_days': 30,
+    'weekly_weeks': 52,
+    'monthly_months': None
+}
+RETENTION_DELETE_PAUSE = 0.01  # pausa dopo ogni file eliminato, limita il carico di I/O sulla scheda SD
+
+store_gc_lock = threading.Lock()
+retention_status = {'last_run': None, 'versions_deleted': 0, 'objects_deleted': 0, 'cursor': None, 'running': False}
+
+def load_retention_policy():
+    policy = dict(DEFAULT_RETENTION_POLICY)
+    if os.path.exists(RETENTION_FILE):
+        try:
+            with open(RETENTION_FILE, 'r') as f:
+                policy.update(validate_retention_policy(json.load(f)))
+        except (json.JSONDecodeError, OSError, ValueError) as e:
+            logger.error(f"Invalid retention policy, automatic pruning disabled: {str(e)}")
+            policy['enabled'] = False
+    return policy
+
+def validate_retention_policy(data):
+    if not isinstance(data, dict):
+        raise ValueError("Retention policy must be an object")
+    policy = {}
+    for key, default in DEFAULT_RETENTION_POLICY.items():
+        value = data.get(key, default)
+        if key == 'enabled':
+            policy[key] = bool(value)
+        elif value is None and key == 'monthly_months':
+            policy[key] = None
+        elif isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+            policy[key] = value
+        else:
+            raise ValueError(f"Invalid value for {key}")
+    if policy['keep_all_days'] < 1:
+        raise ValueError("keep_all_days must be at least 1")
+    return policy
+
+def save_retention_policy(policy):
+    fd, temp_path = tempfile.mkstemp(prefix='retention_', suffix='.part', dir=current_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(policy, f, indent=4)
+    os.replace(temp_path, RETENTION_FILE)
+
+def retention_plan(versions, policy, now=None):
+    """
+    Splits the catalog rows of one device (newest first) into (keep, prune) lists.
+    The newest version is always kept; in each daily/weekly/monthly period the newest version survives.
+    """
+    now = now or datetime.now()
+    keep, prune, periods = [], [], set()
+    for i, version in enumerate(versions):
+        created = datetime.strptime(version['created_at'], '%Y-%m-%d %H:%M:%S')
+        age_days = (now - created).total_seconds() / 86400
+        if i == 0 or age_days <= policy['keep_all_days']:
+            keep.append(version)
+            continue
+        if age_days <= policy['daily_days']:
+            period = ('d', created.date())
+        elif age_days <= policy['weekly_weeks'] * 7:
+            period = ('w',) + tuple(created.isocalendar()[:2])
+        elif policy['monthly_months'] is None or age_days <= policy['monthly_months'] * 30.44:
+            period = ('m', created.year, created.month)
+        else:
+            period = None
+        if period and period not in periods:
+            periods.add(period)
+            keep.append(version)
+        else:
+            prune.append(version)
+    return keep, prune
+
+def _blob_referenced(conn, digest):
+    return bool(
+        conn.execute('SELECT 1 FROM backup_catalog WHERE content_hash = ? LIMIT 1', (digest,)).fetchone()
+        or conn.execute('SELECT 1 FROM store_deltas WHERE base = ? LIMIT 1', (digest,)).fetchone()
+    )
+
+def delete_unreferenced_blob(digest):
+    """Removes a blob no version or delta depends on; returns the base it was a delta of, if any."""
+    conn = get_db()
+    with store_gc_lock:
+        if _blob_referenced(conn, digest):
+            return None
+        path, codec, delta = find_object(digest)
+        row = conn.execute('SELECT base FROM store_deltas WHERE digest = ?', (digest,)).fetchone()
+        if path:
+            os.remove(path)
+        with conn:
+            conn.execute('DELETE FROM store_deltas WHERE digest = ?', (digest,))
+    return row[0] if row else None
+
+def collect_store_garbage(budget):
+    """Sweeps the store for blobs nothing references any more; deletes at most budget files."""
+    conn = get_db()
+    live = {row[0] for row in conn.execute("""
+        WITH RECURSIVE live(digest) AS (
+            SELECT content_hash FROM backup_catalog
+            UNION
+            SELECT d.base FROM store_deltas d JOIN live ON d.digest = live.digest
+        ) SELECT digest FROM live
+    """)}
+    deleted, removed = 0, set()
+    try:
+        for prefix in sorted(os.listdir(STORE_OBJECTS_DIR)):
+            prefix_dir = os.path.join(STORE_OBJECTS_DIR, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for filename in os.listdir(prefix_dir):
+                digest = filename.partition('.')[0]
+                if digest in live:
+                    continue
+                # Un delta eliminato può liberare la propria base: la si riesamina subito
+                while digest and find_object(digest)[0]:
+                    base = delete_unreferenced_blob(digest)
+                    if find_object(digest)[0]:
+                        break
+                    removed.add(digest)
+                    deleted += 1
+                    time.sleep(RETENTION_DELETE_PAUSE)
+                    if deleted >= budget:
+                        return deleted
+                    digest = base if base not in live else None
+    finally:
+        drop_derived_caches(removed)
+    return deleted
+
+def run_retention_pass(policy=None, budget=RETENTION_BUDGET):
+    """
+    One incremental pruning pass: walks the devices from where the previous pass stopped,
+    deleting at most budget versions, then collects the blobs left without references.
+    """
+    policy = policy or load_retention_policy()
+    if not policy['enabled'] or not catalog_ready():
+        return 0, 0
+    conn = get_db()
+    folders = [row[0] for row in conn.execute('SELECT DISTINCT folder FROM backup_catalog ORDER BY folder')]
+    cursor = retention_status['cursor']
+    start = next((i for i, folder in enumerate(folders) if cursor is None or folder > cursor), len(folders))
+
+    retention_status['running'] = True
+    versions_deleted = objects_deleted = 0
+    try:
+        for position in range(start, len(folders)):
+            folder = folders[position]
+            _, prune = retention_plan(catalog_list_versions(folder), policy)
+            for version in prune[:budget - versions_deleted]:
+                delete_version(os.path.join(BACKUP_DIR, folder, version['filename']))
+                versions_deleted += 1
+                time.sleep(RETENTION_DELETE_PAUSE)
+            if versions_deleted >= budget:
+                # Il dispositivo potrebbe avere ancora versioni da eliminare: la prossima passata riparte da qui
+                retention_status['cursor'] = folders[position - 1] if position else None
+                break
+        else:
+            # Giro completo dei dispositivi: si ricomincia dal primo e si libera l'archivio
+            retention_status['cursor'] = None
+            objects_deleted = collect_store_garbage(max(budget - versions_deleted, 1))
+    finally:
+        retention_status.update({
+            'running': False,
+            'last_run': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'versions_deleted': retention_status['versions_deleted'] + versions_deleted,
+            'objects_deleted': retention_status['objects_deleted'] + objects_deleted
+        })
+    if versions_deleted or objects_deleted:
+        logger.info(f"Retention pass: {versions_deleted} versions and {objects_deleted} store objects deleted")
+    return versions_deleted, objects_deleted
+
+def retention_worker():
+    while True:
+        time.sleep(RETENTION_INTERVAL)
+        try:
+            run_retention_pass()
+        except Exception as e:
+            logger.error(f"Retention pass failed: {str(e)}")
+        try:
+            downsample_telemetry()
+        except Exception as e:
+            logger.error(f"Telemetry downsampling failed: {str(e)}")
+
+# Confronto tra versioni con cache dei risultati per coppia di hash
+DIFF_MEMORY_CACHE_SIZE = 64
+_diff_cache = OrderedDict()
+_diff_cache_lock = threading.Lock()
+
+def resolve_backup_path(filepath):
+    """
+    Absolute path of a logical version (backups/<hostname>/<name>.txt), or None if it points
+    anywhere else, the internal store (STORE_DIR) included. Existence is checked with version_exists.
+    """
+    if not isinstance(filepath, str):
+        return None
+    backup_dir = os.path.abspath(BACKUP_DIR)
+    requested_path = os.path.abspath(os.path.join(backup_dir, os.path.normpath(filepath)))
+    folder = os.path.dirname(requested_path)
+    if os.path.dirname(folder) != backup_dir or not requested_path.endswith('.txt'):
+        return None
+    # Blob, cache e file temporanei dell'archivio non sono versioni
+    if folder == os.path.abspath(STORE_DIR) or os.path.basename(folder).startswith('.'):
+        return None
+    return requested_path
+
+def version_digest(version_path):
+    digest = read_version_ref(version_path)
+    if digest:
+        return digest
+    return hashlib.sha256(read_version(version_path).encode('utf-8')).hexdigest()
+
+def _prune_cache_dir(directory, max_bytes):
+    """Removes the least recently used files of a cache directory until it fits in max_bytes."""
+    entries = []
+    for filename in os.listdir(directory):
+        try:
+            stat = os.stat(os.path.join(directory, filename))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, filename))
+    total = sum(size for _, size, _ in entries)
+    for _, size, filename in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, filename))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def _prune_raw_cache():
+    _prune_cache_dir(STORE_RAW_DIR, RAW_CACHE_MAX_BYTES)
+
+def drop_derived_caches(digests):
+    """Forgets the raw copies and cached diffs involving blobs the garbage collection deleted."""
+    if not digests:
+        return
+    for digest in digests:
+        try:
+            os.remove(os.path.join(STORE_RAW_DIR, digest + '.txt'))
+        except FileNotFoundError:
+            pass
+    # Le voci dei diff sono <hash_da>_<hash_a>_<contesto>.json.gz
+    for filename in os.listdir(STORE_DIFFS_DIR):
+        if set(filename.split('_')[:2]) & digests:
+            try:
+                os.remove(os.path.join(STORE_DIFFS_DIR, filename))
+            except FileNotFoundError:
+                pass
+    with _diff_cache_lock:
+        for key in [key for key in _diff_cache if set(key.split('_')[:2]) & digests]:
+            del _diff_cache[key]
+
+def raw_version_file(version_path):
+    """
+    Returns (path, digest) of a plain-text file with the content of a version, suitable for send_file.
+    Uncompressed keyframes and legacy files are served in place; other blobs are materialized once
+    in STORE_RAW_DIR (an mtime-ordered cache bounded by RAW_CACHE_MAX_BYTES).
+    """
+    digest = read_version_ref(version_path)
+    if not digest:
+        return version_path, version_digest(version_path)
+    path, codec, delta = find_object(digest)
+    if path and codec == 'none' and not delta:
+        return path, digest
+
+    raw_path = os.path.join(STORE_RAW_DIR, digest + '.txt')
+    if os.path.exists(raw_path):
+        os.utime(raw_path)
+        return raw_path, digest
+    fd, temp_path = tempfile.mkstemp(prefix='raw_', suffix='.part', dir=STORE_TMP_DIR)
+    try:
+        with open_object(digest) as src, os.fdopen(fd, 'w', encoding='utf-8', newline='') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(temp_path, raw_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    _prune_raw_cache()
+    return raw_path, digest
+
+def previous_version_path(version_path):
+    """Path of the version stored right before version_path for the same device, if any."""
+    switch_folder, filename = os.path.dirname(version_path), os.path.basename(version_path)
+    if catalog_ready():
+        entries = catalog_list_versions(os.path.basename(switch_folder), limit=1, before=filename)
+        names = [entry['filename'] for entry in entries]
+    else:
+        names = [name for name in list_versions(switch_folder) if name < filename][:1]
+    return os.path.join(switch_folder, names[0]) if names else None
+
+def compute_diff(from_path, to_path, context=3):
+    """
+    Diff between two stored versions as structured hunks plus unified text. Results are cached
+    in memory and on disk under the pair of content hashes, so repeated views cost no recomputation.
+    """
+    from_digest, to_digest = version_digest(from_path), version_digest(to_path)
+    key = f"{from_digest}_{to_digest}_{int(context)}"
+
+    with _diff_cache_lock:
+        if key in _diff_cache:
+            _diff_cache.move_to_end(key)
+            return _diff_cache[key]
+
+    cache_path = os.path.join(STORE_DIFFS_DIR, key + '.json.gz')
+    result = None
+    if os.path.exists(cache_path):
+        try:
+            with gzip.open(cache_path, 'rt', encoding='utf-8') as f:
+                result = json.load(f)
+            os.utime(cache_path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable diff cache entry {key}: {str(e)}")
+
+    if result is None:
+        from_lines = read_version(from_path).split('\n')
+        to_lines = read_version(to_path).split('\n')
+        hunks = []
+        for group in difflib.SequenceMatcher(None, from_lines, to_lines).get_grouped_opcodes(int(context)):
+            hunk = {
+                'from_start': group[0][1] + 1,
+                'from_count': group[-1][2] - group[0][1],
+                'to_start': group[0][3] + 1,
+                'to_count': group[-1][4] - group[0][3],
+                'lines': []
+            }
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    hunk['lines'].extend({'op': ' ', 'text': line} for line in from_lines[i1:i2])
+                    continue
+                hunk['lines'].extend({'op': '-', 'text': line} for line in from_lines[i1:i2])
+                hunk['lines'].extend({'op': '+', 'text': line} for line in to_lines[j1:j2])
+            hunks.append(hunk)
+
+        unified = []
+        for hunk in hunks:
+            unified.append(f"@@ -{hunk['from_start']},{hunk['from_count']} +{hunk['to_start']},{hunk['to_count']} @@")
+            unified.extend(line['op'] + line['text'] for line in hunk['lines'])
+
+        result = {
+            'from_hash': from_digest,
+            'to_hash': to_digest,
+            'identical': from_digest == to_digest,
+            'added': sum(1 for h in hunks for line in h['lines'] if line['op'] == '+'),
+            'removed': sum(1 for h in hunks for line in h['lines'] if line['op'] == '-'),
+            'hunks': hunks,
+            'unified': "\n".join(unified)
+        }
+        fd, temp_path = tempfile.mkstemp(prefix='diff_', suffix='.part', dir=STORE_TMP_DIR)
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+            f.write(json.dumps(result).encode('utf-8'))
+        os.replace(temp_path, cache_path)
+        _prune_cache_dir(STORE_DIFFS_DIR, DIFF_CACHE_MAX_BYTES)
+
+    with _diff_cache_lock:
+        _diff_cache[key] = result
+        while len(_diff_cache) > DIFF_MEMORY_CACHE_SIZE:
+            _diff_cache.popitem(last=False)
+    return result
+
+# Funzioni di supporto per la sessione SSH interattiva
+def build_prompt_pattern(net_connect):
+    """
+    Regex matching the device prompt (e.g. 'sw1#', 'sw1(config)#', 'sw1>') on its own line at the
+    end of the output, so config lines mentioning the hostname (' description to sw1 core#') don't match.
+    """
+    base_prompt = getattr(net_connect, 'base_prompt', '') or net_connect.find_prompt()[:-1]
+    return re.compile(r'(?:^|[\r\n])' + re.escape(base_prompt.strip()) + r'[^\r\n]{0,32}[>#$%][ \t]*$')
+
+def read_until_prompt(net_connect, prompt_re, timeout, trailer_re=None, sink=None):
+    """
+    Reads the channel until the device prompt (or the optional configuration trailer) closes
+    the output, answering '--More--' pagers along the way. When sink is given, chunks are
+    written to it as they arrive instead of being returned.
+
+    Raises:
+        TimeoutError: If neither is seen within the phase budget
+    """
+    chunks = []
+    tail = ""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        new_data = net_connect.read_channel()
+        if not new_data:
+            time.sleep(SSH_POLL_INTERVAL)
+            continue
+
+        if sink is not None:
+            sink.write(new_data)
+        else:
+            chunks.append(new_data)
+        tail = (tail + new_data)[-512:]
+        if '--More--' in new_data:
+            net_connect.write_channel(' ')
+        elif prompt_re.search(tail) or (trailer_re and trailer_re.search(tail)):
+            return "".join(chunks)
+
+    raise TimeoutError(f"No prompt received within {timeout}s")
+
+def resync_session(net_connect, timeout):
+    """
+    Brings a session left mid-output (e.g. stopped at a pager) back to a clean prompt:
+    interrupts the running command with Ctrl-C, then waits for the prompt after a newline.
+    """
+    net_connect.write_channel('\x03')
+    time.sleep(SSH_POLL_INTERVAL)
+    net_connect.clear_buffer()
+    prompt_re = build_prompt_pattern(net_connect)
+    net_connect.write_channel('\n')
+    read_until_prompt(net_connect, prompt_re, timeout)
+    net_connect.clear_buffer()
+
+class ConfigCapture:
+    """
+    Streams a configuration into the content-addressed store while it is read.
+    Lines are normalized (CRLF, trailing blanks) and hashed on the fly; the first trim_head
+    lines are dropped and the last line is held back, so a trailing prompt can be trimmed
+    without keeping the whole output in memory.
+    """
+
+    def __init__(self, trim_head=0):
+        self.trim_head = trim_head
+        self.line_count = 0
+        self.bytes_written = 0
+        self.lines_written = 0
+        self.last_line = None
+        self.digest = None
+        self._pending = ""
+        self._held = None
+        self._first = True
+        self._hash = hashlib.sha256()
+        fd, self.temp_path = tempfile.mkstemp(prefix='capture_', suffix='.part', dir=STORE_TMP_DIR)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        lines = (self._pending + chunk).split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self._add_line(line.rstrip())
+
+    def _add_line(self, line):
+        self.line_count += 1
+        if self.line_count <= self.trim_head:
+            return
+        if self._held is not None:
+            self._emit(self._held)
+        self._held = line
+
+    def _emit(self, line):
+        data = (line if self._first else '\n' + line).encode('utf-8')
+        self._first = False
+        self._hash.update(data)
+        self._file.write(data)
+        self.bytes_written += len(data)
+        self.lines_written += 1
+        if line.strip():
+            self.last_line = line
+
+    def finish(self, drop_last_re=None):
+        """Flushes the held-back lines; the very last one is dropped if it matches drop_last_re."""
+        if self._pending:
+            self._add_line(self._pending.rstrip())
+            self._pending = ""
+        if self._held is not None:
+            if not (drop_last_re and drop_last_re.search(self._held)):
+                self._emit(self._held)
+            self._held = None
+
+    def has_trailer(self, trailer_re):
+        """True when the last non-blank line stored is the configuration trailer (e.g. 'end')."""
+        return self.last_line is not None and bool(trailer_re.search('\n' + self.last_line + '\n'))
+
+    def commit(self, version_path, method=None, duration=None, base_digest=None):
+        """
+        Stores the capture as a blob (once per distinct content), records version_path pointing
+        at it and adds the version to the backup catalog. The delta base defaults to the newest
+        version of the device; callers that already know it pass base_digest.
+        """
+        self.finish()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self.digest = self._hash.hexdigest()
+        if base_digest is None:
+            base_digest = latest_version_digest(os.path.dirname(version_path))
+        prepared = None
+        try:
+            while True:
+                # Delta o compressione si preparano fuori dal lock; sotto il lock solo rinomina e registrazioni
+                if prepared is None and not find_object(self.digest)[0]:
+                    prepared = prepare_object_file(self.temp_path, self.digest, base_digest=base_digest)
+                # Il blob deve risultare referenziato prima che la garbage collection possa riesaminarlo
+                with store_gc_lock:
+                    if install_object_file(prepared, self.digest):
+                        write_version_ref(version_path, self.digest)
+                        catalog_add_version(version_path, self.digest, self.bytes_written, self.lines_written, method, duration)
+                        break
+                # Blob o base del delta raccolti nel frattempo: si riprepara come keyframe
+                if prepared and prepared[0] != self.temp_path:
+                    os.remove(prepared[0])
+                prepared, base_digest = None, None
+        finally:
+            for path in (self.temp_path, prepared and prepared[0]):
+                if path and os.path.exists(path):
+                    os.remove(path)
+        search_index_version(version_path, self.digest)
+        return self.digest
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+def is_session_alive(net_connect):
+    try:
+        return net_connect.is_alive()
+    except Exception:
+        return False
+
+def close_session(net_connect):
+    try:
+        net_connect.disconnect()
+    except Exception as e:
+        logger.debug(f"Error while closing SSH session: {str(e)}")
+
+# Telemetria dei backup (serie temporale per dispositivo)
+TELEMETRY_FIELDS = ['device_id', 'hostname', 'started_at', 'connect_time', 'setup_time', 'retrieve_time',
+                    'total_time', 'bytes', 'lines', 'method', 'outcome', 'error_type']
+TELEMETRY_DAY_SELECT = """
+    SELECT device_id, MAX(hostname), substr(started_at, 1, 10) AS day, COUNT(*), SUM(outcome = 'failure'),
+           AVG(connect_time), AVG(setup_time), AVG(retrieve_time), AVG(total_time), MAX(total_time),
+           AVG(bytes), AVG(lines)
+    FROM backup_runs
+"""
+TELEMETRY_DAILY_COLUMNS = ['device_id', 'hostname', 'day', 'runs', 'failures', 'avg_connect', 'avg_setup',
+                           'avg_retrieve', 'avg_total', 'max_total', 'avg_bytes', 'avg_lines']
+
+def record_backup_run(result, telemetry):
+    """Stores one run in the telemetry series; failures are logged, never raised."""
+    if result.get('id') is None:
+        return
+    row = {
+        **telemetry,
+        'device_id': result['id'],
+        'hostname': result.get('hostname'),
+        'method': result.get('method'),
+        'outcome': 'success' if result.get('success') else 'failure',
+        'error_type': result.get('error_type')
+    }
+    for key in ('connect_time', 'setup_time', 'retrieve_time', 'total_time'):
+        if row.get(key) is not None:
+            row[key] = round(row[key], 3)
+    try:
+        conn = get_db()
+        with conn:
+            conn.execute(
+                f"INSERT INTO backup_runs ({', '.join(TELEMETRY_FIELDS)}) VALUES ({', '.join('?' * len(TELEMETRY_FIELDS))})",
+                [row.get(field) for field in TELEMETRY_FIELDS]
+            )
+    except Exception as e:
+        logger.error(f"Unable to record backup telemetry for {row['hostname']}: {str(e)}")
+
+def downsample_telemetry():
+    """Folds the runs older than TELEMETRY_RAW_DAYS into one row per device and day."""
+    cutoff = (datetime.now() - timedelta(days=TELEMETRY_RAW_DAYS)).strftime('%Y-%m-%d')
+    conn = get_db()
+    with conn:
+        folded = conn.execute(
+            f"INSERT OR REPLACE INTO backup_runs_daily ({', '.join(TELEMETRY_DAILY_COLUMNS)}) "
+            f"{TELEMETRY_DAY_SELECT} WHERE started_at < ? GROUP BY device_id, day", (cutoff,)
+        ).rowcount
+        conn.execute('DELETE FROM backup_runs WHERE started_at < ?', (cutoff,))
+    if folded > 0:
+        logger.info(f"Backup telemetry downsampled: {folded} device-days aggregated")
+
+def telemetry_days(since_day, device_id=None):
+    """Per device and day aggregates from the rollups and the raw runs, oldest first."""
+    device_filter = ' AND device_id = ?' if device_id is not None else ''
+    args = [since_day] + ([device_id] if device_id is not None else [])
+    query = (
+        f"SELECT {', '.join(TELEMETRY_DAILY_COLUMNS)} FROM backup_runs_daily WHERE day >= ?{device_filter} "
+        f"UNION ALL {TELEMETRY_DAY_SELECT} WHERE started_at >= ?{device_filter} GROUP BY device_id, day "
+        "ORDER BY day, device_id"
+    )
+    return [dict(zip(TELEMETRY_DAILY_COLUMNS, row)) for row in get_db().execute(query, args + args)]
+
+def _weighted(rows, key):
+    weighted = [(row[key], row['runs']) for row in rows if row[key] is not None]
+    total = sum(runs for _, runs in weighted)
+    return round(sum(value * runs for value, runs in weighted) / total, 3) if total else None
+
+def summarize_telemetry(rows):
+    return {
+        'runs': sum(row['runs'] for row in rows),
+        'failures': sum(row['failures'] or 0 for row in rows),
+        'avg_connect': _weighted(rows, 'avg_connect'),
+        'avg_setup': _weighted(rows, 'avg_setup'),
+        'avg_retrieve': _weighted(rows, 'avg_retrieve'),
+        'avg_total': _weighted(rows, 'avg_total'),
+        'max_total': max((row['max_total'] for row in rows if row['max_total'] is not None), default=None),
+        'avg_bytes': _weighted(rows, 'avg_bytes')
+    }
+
 def backup_switch(params: dict) -> dict:
     """
     Performs network switch configuration backup using multiple connection methods and retrieval techniques.
@@ -3220,6 +5501,7 @@ def backup_switch(params: dict) -> dict:
     Args:
         params: Dictionary containing parameters:
             - index (int): Switch index in the devices list
+            - id (int, optional): Device id, used instead of index when given
             - scheduled (bool, optional): Flag for scheduled backup. Default False.
             - retry_count (int, optional): Number of retry attempts. Default 2.
 
@@ -3236,28 +5518,38 @@ def backup_switch(params: dict) -> dict:
     Raises:
         ValueError: If input parameters are invalid
     """
+    started = time.monotonic()
+    telemetry = {'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    result = _backup_switch(params, telemetry)
+    telemetry['total_time'] = time.monotonic() - started
+    record_backup_run(result, telemetry)
+    publish_event(
+        'backup_finish',
+        id=result.get('id'),
+        duration=round(time.monotonic() - started, 3),
+        **{k: result.get(k) for k in ('hostname', 'ip', 'success', 'message', 'filename', 'error_type', 'method')}
+    )
+    result.pop('id', None)
+    return result
+
+def _backup_switch(params: dict, telemetry: dict) -> dict:
+    """Backup procedure behind backup_switch(); phase timings and sizes are stored in telemetry."""
     # Initial parameter validation
-    if not isinstance(params, dict) or 'index' not in params:
+    if not isinstance(params, dict) or ('index' not in params and 'id' not in params):
         raise ValueError("Missing or invalid parameters")
 
     logger.debug(f"Starting backup with params: { {k:v for k,v in params.items() if k not in ['password', 'secret']} }")
 
     try:
-        # Validate switch index
-        index = params.get('index')
-        switches_data = load_switches()
-        
-        if not isinstance(switches_data, list):
-            error_msg = "Invalid switches data format"
-            logger.error(error_msg)
-            return {
-                'success': False,
-                'message': error_msg,
-                'error_type': 'DataError'
-            }
+        # Validate switch index / id
+        if 'id' in params:
+            switch = get_switch_by_id(int(params['id']))
+            error_msg = f"Invalid switch id {params['id']}"
+        else:
+            switch = get_switch(int(params['index']))
+            error_msg = f"Invalid switch index {params['index']}"
 
-        if index < 0 or index >= len(switches_data):
-            error_msg = f"Invalid switch index {index}"
+        if not switch:
             logger.error(error_msg)
             return {
                 'success': False,
@@ -3266,14 +5558,15 @@ def backup_switch(params: dict) -> dict:
             }
 
         # Extract device information
-        switch = switches_data[index]
+        switch_id = switch['id']
         hostname = switch['hostname']
         ip = switch['ip']
         username = switch['username']
         password = decrypt_password(switch['password'])
         enable_password = decrypt_password(switch['enable_password'])
         device_type = switch.get('device_type', 'cisco_ios')
-        custom_command = switch.get('backup_command')
+        profile = get_backup_profile(device_type)
+        config_command = switch.get('backup_command') or profile['config_command']
 
         # Prepare connection parameters
         device = {
@@ -3291,6 +5584,8 @@ def backup_switch(params: dict) -> dict:
         }
 
         logger.info(f"[{hostname}] Starting backup procedure")
+        started = time.monotonic()
+        publish_event('backup_start', id=switch_id, hostname=hostname, ip=ip)
 
         # Prepare backup file
         switch_folder = os.path.join(BACKUP_DIR, secure_filename(hostname))
@@ -3299,124 +5594,153 @@ def backup_switch(params: dict) -> dict:
         backup_filename = f"{hostname}_config_{timestamp}.txt"
         backup_path = os.path.join(switch_folder, backup_filename)
 
-        # Attempt interactive backup method
+        # Una sola sessione SSH per tentativo di backup, condivisa dal metodo di fallback
+        publish_event('backup_phase', id=switch_id, hostname=hostname, phase='connect')
+        phase_started = time.monotonic()
+        try:
+            net_connect = ConnectHandler(**device)
+        finally:
+            # Anche i tentativi falliti (timeout, autenticazione) hanno una durata di connessione
+            telemetry['connect_time'] = time.monotonic() - phase_started
         try:
-            with ConnectHandler(**device) as net_connect:
+            # Attempt interactive backup method
+            try:
                 logger.info(f"[{hostname}] Connected, starting interactive backup")
                 
-                time.sleep(10)
-                
-                # Configure session
-                net_connect.enable()
+                # Configure session (setup_time: enable, prompt detection, paging)
+                phase_started = time.monotonic()
+                if profile['enable']:
+                    net_connect.enable()
+                prompt_re = build_prompt_pattern(net_connect)
                 net_connect.write_channel('\n')
-                time.sleep(1)
+                read_until_prompt(net_connect, prompt_re, profile['timeouts']['prompt'])
                 
                 # Disable pagination
-                pagination_commands = [
-                    'terminal length 0\n',
-                    'terminal width 512\n',
-                    #'set cli screen-length 0\n'
-                ]
-                
-                for cmd in pagination_commands:
-                    net_connect.write_channel(cmd)
-                    time.sleep(2)
-                
-                # Retrieve configuration
-                full_output = ""
-                config_commands = ['show running-config\n']
+                for cmd in profile['paging_commands']:
+                    net_connect.write_channel(cmd + '\n')
+                    read_until_prompt(net_connect, prompt_re, profile['timeouts']['paging'])
+                telemetry['setup_time'] = time.monotonic() - phase_started
                 
-                for cmd in config_commands:
-                    logger.info(f"[{hostname}] Executing: {cmd.strip()}")
-                    net_connect.write_channel(cmd)
-                    
-                    start_time = time.time()
-                    while time.time() - start_time < 60:
-                        time.sleep(3)
-                        new_data = net_connect.read_channel()
-                        if new_data:
-                            full_output += new_data
-                            if any(pattern in new_data for pattern in ['#', 'end', '--More--']):
-                                if '--More--' in new_data:
-                                    net_connect.write_channel(' ')
-                                break
-
-                # Validate output
-                if len(full_output.splitlines()) < 20:
-                    raise Exception("Insufficient configuration data")
-
-                # Clean and save configuration
-                clean_output = "\n".join(
-                    full_output.splitlines()[5:-1] 
-                    if len(full_output.splitlines()) > 5 
-                    else full_output.splitlines()[:-1]
-                )
-                
-                with open(backup_path, 'w', encoding='utf-8') as f:
-                    f.write(clean_output)
+                # Retrieve configuration, streaming it to disk while it is read
+                logger.info(f"[{hostname}] Executing: {config_command}")
+                publish_event('backup_phase', id=switch_id, hostname=hostname, phase='retrieve')
+                capture = ConfigCapture(trim_head=profile['trim_head'])
+                phase_started = time.monotonic()
+                try:
+                    net_connect.write_channel(config_command + '\n')
+                    read_until_prompt(
+                        net_connect, prompt_re, profile['timeouts']['config'],
+                        trailer_re=profile['end_re'], sink=capture
+                    )
+
+                    # Clean configuration: command echo/banner already dropped, now the trailing prompt
+                    capture.finish(drop_last_re=prompt_re if profile['trim_prompt'] else None)
+
+                    # Validate output
+                    if capture.line_count < profile['min_lines']:
+                        raise Exception("Insufficient configuration data")
+                    if profile['end_re'] and not capture.has_trailer(profile['end_re']):
+                        raise Exception("Configuration trailer missing, output truncated")
+
+                    telemetry.update(retrieve_time=time.monotonic() - phase_started,
+                                     bytes=capture.bytes_written, lines=capture.lines_written)
+                    capture.commit(backup_path, method='interactive', duration=time.monotonic() - started)
+                except Exception:
+                    capture.discard()
+                    raise
 
                 logger.info(f"[{hostname}] Backup completed successfully")
-                switches_data[index]['last_backup_status'] = 'success'
-                switches_data[index]['last_backup_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                save_switches(switches_data)
+                set_backup_status(switch_id, 'success')
                 return {
                     'success': True,
                     'message': "Backup completed",
+                    'id': switch_id,
                     'hostname': hostname,
                     'ip': ip,
-                    'filename': backup_filename
+                    'filename': backup_filename,
+                    'method': 'interactive'
                 }
 
 
 
-        except Exception as e:
-            switches_data[index]['last_backup_status'] = 'failed'
-            switches_data[index]['last_backup_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            save_switches(switches_data)
-            logger.warning(f"[{hostname}] Interactive method failed, trying simple method: {str(e)}")
+            except Exception as e:
+                set_backup_status(switch_id, 'failed')
+                logger.warning(f"[{hostname}] Interactive method failed, trying simple method: {str(e)}")
             
-            # Fallback to simple method
-            try:
-                with ConnectHandler(**device) as net_connect:
+                # Fallback to simple method, on the same session unless the transport is dead
+                publish_event('backup_phase', id=switch_id, hostname=hostname, phase='fallback')
+                try:
+                    reconnect = not is_session_alive(net_connect)
+                    if reconnect:
+                        logger.info(f"[{hostname}] Session lost, reconnecting for simple method")
+                    else:
+                        # La lettura interattiva può essersi fermata a metà (pager, comando in corso)
+                        try:
+                            resync_session(net_connect, profile['timeouts']['prompt'])
+                        except Exception as resync_error:
+                            logger.info(f"[{hostname}] Session not back at the prompt ({str(resync_error)}), reconnecting")
+                            reconnect = True
+                    if reconnect:
+                        close_session(net_connect)
+                        net_connect = ConnectHandler(**device)
+
+                    phase_started = time.monotonic()
                     output = net_connect.send_command_timing(
-                        custom_command or 'show running-config',
+                        config_command,
                         delay_factor=5,
                         max_loops=3000
                     )
+                    telemetry['retrieve_time'] = time.monotonic() - phase_started
                     
                     if not output or len(output.splitlines()) < 10:
                         raise Exception("Insufficient output")
                     
-                    with open(backup_path, 'w', encoding='utf-8') as f:
-                        f.write(output)
+                    capture = ConfigCapture()
+                    try:
+                        capture.write(output)
+                        capture.finish()
+                        if profile['end_re'] and not capture.has_trailer(profile['end_re']):
+                            raise Exception("Configuration trailer missing, output truncated")
+                        telemetry.update(bytes=capture.bytes_written, lines=capture.lines_written)
+                        capture.commit(backup_path, method='fallback', duration=time.monotonic() - started)
+                    except Exception:
+                        capture.discard()
+                        raise
 
                     logger.info(f"[{hostname}] Backup completed with simple method")
                     return {
                         'success': True,
                         'message': "Backup completed with fallback method",
+                        'id': switch_id,
                         'hostname': hostname,
                         'ip': ip,
-                        'filename': backup_filename
+                        'filename': backup_filename,
+                        'method': 'fallback'
                     }
 
-            except Exception as fallback_error:
-                error_msg = f"All backup methods failed: {str(fallback_error)}"
-                logger.error(f"[{hostname}] {error_msg}")
-                return {
-                    'success': False,
-                    'message': error_msg,
-                    'hostname': hostname,
-                    'ip': ip,
-                    'error_type': 'BackupError',
-                    'output': output[:1000] if 'output' in locals() else None
-                }
+                except Exception as fallback_error:
+                    error_msg = f"All backup methods failed: {str(fallback_error)}"
+                    logger.error(f"[{hostname}] {error_msg}")
+                    return {
+                        'success': False,
+                        'message': error_msg,
+                        'id': switch_id,
+                        'hostname': hostname,
+                        'ip': ip,
+                        'error_type': 'BackupError',
+                        'output': output[:1000] if 'output' in locals() else None
+                    }
+        finally:
+            close_session(net_connect)
 
     except (NetMikoTimeoutException, NetMikoAuthenticationException) as e:
         error_msg = f"Connection error: {str(e)}"
         logger.error(f"[{hostname}] {error_msg}")
+        set_backup_status(switch_id, 'failed')
         return {
             'success': False,
             'message': error_msg,
+            'id': switch_id,
             'hostname': hostname,
             'ip': ip,
             'error_type': type(e).__name__
@@ -3428,6 +5752,7 @@ def backup_switch(params: dict) -> dict:
         return {
             'success': False,
             'message': error_msg,
+            'id': switch_id if 'switch_id' in locals() else None,
             'hostname': hostname if 'hostname' in locals() else 'unknown',
             'ip': ip if 'ip' in locals() else 'unknown',
             'error_type': 'UnexpectedError'
@@ -3438,6 +5763,13 @@ def backup_switch(params: dict) -> dict:
 @app.route('/backup_all_switches', methods=['POST'])
 @login_required
 def backup_all_switches():
+    # Corpo opzionale: se presente deve essere un oggetto JSON
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Request body must be a JSON object'}), 400
+
     try:
         logger.info("Starting backup process for all devices")
         
@@ -3475,12 +5807,26 @@ def backup_all_switches():
                 'results': []
             })
 
+        # Numero di worker opzionale dalla richiesta (1..BACKUP_WORKERS_MAX), altrimenti BACKUP_WORKERS
+        try:
+            workers = max(1, min(int(data.get('workers') or BACKUP_WORKERS), BACKUP_WORKERS_MAX))
+        except (TypeError, ValueError):
+            workers = BACKUP_WORKERS
+
+        if data.get('async'):
+            job_id = submit_backup_job(switches_data, workers=workers)
+            return jsonify({
+                'success': True,
+                'message': 'Backup queued',
+                'job_id': job_id,
+                'total': len(switches_data)
+            }), 202
+
+        logger.info(f"Processing {len(switches_data)} devices with up to {workers} parallel workers")
+        backup_results = run_parallel_backups([switch['id'] for switch in switches_data], workers=workers)
+
         results = []
-        for i, switch in enumerate(switches_data, 1):
-            progress_msg = f"Processing device {i}/{len(switches_data)}: {switch['hostname']}"
-            logger.info(progress_msg)
-            
-            result = backup_switch({'index': i-1})
+        for switch, result in zip(switches_data, backup_results):
             results.append({
                 'success': result.get('success', False),
                 'hostname': switch['hostname'],
@@ -3511,29 +5857,100 @@ def backup_all_switches():
             'results': []
         }), 500
 
+@app.route('/backup_jobs', methods=['GET'])
+@limiter.exempt
+@login_required
+def list_backup_jobs():
+    with backup_jobs_lock:
+        jobs = [{
+            'job_id': job['id'],
+            'status': job['status'],
+            'created_at': job['created_at'],
+            'finished_at': job['finished_at'],
+            'done': job['done'],
+            'count': job['count'],
+            'total': job['total']
+        } for job in backup_jobs.values()]
+    return jsonify({'success': True, 'jobs': sorted(jobs, key=lambda j: j['created_at'], reverse=True)})
+
+@app.route('/backup_jobs/<job_id>', methods=['GET'])
+@limiter.exempt
+@login_required
+def get_backup_job_api(job_id):
+    job = get_backup_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/events/stream', methods=['GET'])
+@limiter.exempt
+@login_required
+def event_stream():
+    subscriber = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    with event_subscribers_lock:
+        event_subscribers.add(subscriber)
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    event = subscriber.get(timeout=15)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            with event_subscribers_lock:
+                event_subscribers.discard(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/get_switch_backups', methods=['POST'])
 @login_required
 def get_switch_backups():
-    data = request.get_json()
-    if 'index' not in data:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'index' not in data:
         return jsonify({'success': False, 'message': 'Indice mancante'})
     
-    switches_data = load_switches()
-    index = int(data['index'])
+    # Paginazione opzionale: 'limit' e cursore 'before' (filename dell'ultima versione ricevuta)
+    try:
+        index = int(data['index'])
+        limit = int(data['limit']) if data.get('limit') not in (None, '') else None
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be a positive integer")
+        before = data.get('before') or None
+        if before is not None and not isinstance(before, str):
+            raise ValueError("before must be a backup filename")
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': f'Parametri non validi: {str(e)}'}), 400
+    
+    switch = get_switch(index)
     
-    if index < 0 or index >= len(switches_data):
+    if not switch:
         return jsonify({'success': False, 'message': 'Indice switch non valido'})
     
-    switch = switches_data[index]
     hostname = switch['hostname']
     switch_folder = os.path.join(BACKUP_DIR, secure_filename(hostname))
     
-    if not os.path.exists(switch_folder):
-        return jsonify({'success': True, 'hostname': hostname, 'backups': []})
-    
     backups = []
-    for filename in sorted(os.listdir(switch_folder), reverse=True):
-        if filename.endswith('.txt'):
+    if catalog_ready():
+        for entry in catalog_list_versions(os.path.basename(switch_folder), limit, before):
+            backups.append({
+                'filename': entry['filename'],
+                'path': os.path.join(switch_folder, entry['filename']),
+                'timestamp': entry['created_at'],
+                'size': entry['size'],
+                'lines': entry['line_count'],
+                'hash': entry['content_hash'],
+                'method': entry['method'],
+                'duration': entry['duration']
+            })
+    else:
+        for filename in list_versions(switch_folder):
             filepath = os.path.join(switch_folder, filename)
             backups.append({
                 'filename': filename,
@@ -3543,7 +5960,8 @@ def get_switch_backups():
     return jsonify({
         'success': True,
         'hostname': hostname,
-        'backups': backups
+        'backups': backups,
+        'next_before': backups[-1]['filename'] if limit and len(backups) == limit else None
     })
 
 @app.route('/get_backup_content', methods=['POST'])
@@ -3563,22 +5981,17 @@ def get_backup_content():
         if not isinstance(filepath, str):
             raise ValueError("Filepath must be a string")
             
-        # Normalizzazione del percorso per prevenire directory traversal
-        filepath = os.path.normpath(filepath)
-        backup_dir = os.path.abspath(BACKUP_DIR)
-        requested_path = os.path.abspath(os.path.join(backup_dir, filepath))
-        
-        # Verifica che il percorso sia dentro la directory dei backup
-        if not requested_path.startswith(backup_dir + os.sep):
+        # Normalizzazione del percorso per prevenire directory traversal e l'accesso all'archivio interno
+        requested_path = resolve_backup_path(filepath)
+        if not requested_path:
             return jsonify({'success': False, 'message': 'Invalid file path'}), 403
         
         # Verifica esistenza file
-        if not os.path.isfile(requested_path):
+        if not version_exists(requested_path):
             return jsonify({'success': False, 'message': 'File not found'}), 404
         
         # Lettura e sanitizzazione del contenuto
-        with open(requested_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        content = read_version(requested_path)
         
         # Sanitizzazione del contenuto per prevenire XSS
         sanitized_content = escape(content)
@@ -3597,22 +6010,234 @@ def get_backup_content():
         logging.error(f"Error accessing backup file: {str(e)}", exc_info=True)
         return jsonify({'success': False, 'message': 'Internal server error'}), 500
 
+@app.route('/backup_raw', methods=['GET'])
+@limiter.exempt
+@login_required
+def backup_raw():
+    """
+    Serves a stored version as text/plain via send_file, with a strong ETag equal to its content
+    hash, If-None-Match revalidation and byte ranges (?path=<backup path>, download=1 for attachment).
+    """
+    requested_path = resolve_backup_path(request.args.get('path', ''))
+    if not requested_path:
+        return jsonify({'success': False, 'message': 'Invalid file path'}), 403
+    if not version_exists(requested_path):
+        return jsonify({'success': False, 'message': 'File not found'}), 404
+
+    try:
+        raw_path, digest = raw_version_file(requested_path)
+        response = send_file(
+            raw_path,
+            mimetype='text/plain',
+            as_attachment=request.args.get('download') == '1',
+            download_name=os.path.basename(requested_path),
+            conditional=True,
+            etag=digest,
+            max_age=0
+        )
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    except FileNotFoundError:
+        return jsonify({'success': False, 'message': 'File not found'}), 404
+    except Exception as e:
+        logger.error(f"Error serving raw backup {requested_path}: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+@app.route('/diff_backups', methods=['POST'])
+@login_required
+def diff_backups():
+    data = request.get_json(silent=True) or {}
+    if 'to' not in data:
+        return jsonify({'success': False, 'message': 'Missing file path'}), 400
+
+    try:
+        to_path = resolve_backup_path(data['to'])
+        # Senza 'from' la versione viene confrontata con quella precedente dello stesso dispositivo
+        from_path = resolve_backup_path(data['from']) if data.get('from') else (to_path and previous_version_path(to_path))
+        if not to_path or ('from' in data and not from_path):
+            return jsonify({'success': False, 'message': 'Invalid file path'}), 403
+        if not version_exists(to_path):
+            return jsonify({'success': False, 'message': 'File not found'}), 404
+        if not from_path or not version_exists(from_path):
+            return jsonify({'success': False, 'message': 'No version to compare with'}), 404
+
+        result = compute_diff(from_path, to_path, context=max(0, min(int(data.get('context', 3)), 50)))
+        response = {
+            'success': True,
+            'from': os.path.basename(from_path),
+            'to': os.path.basename(to_path),
+            'from_hash': result['from_hash'],
+            'to_hash': result['to_hash'],
+            'identical': result['identical'],
+            'added': result['added'],
+            'removed': result['removed']
+        }
+        # Contenuto sanitizzato come in get_backup_content
+        if data.get('format') == 'structured':
+            response['hunks'] = [
+                {**hunk, 'lines': [{'op': line['op'], 'text': escape(line['text'])} for line in hunk['lines']]}
+                for hunk in result['hunks']
+            ]
+        else:
+            response['diff'] = escape(result['unified'])
+        return jsonify(response)
+
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error comparing backups: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+@app.route('/search_configs', methods=['GET'])
+@login_required
+def search_configs_api():
+    text = request.args.get('q', '').strip()
+    if len(text) < 2:
+        return jsonify({'success': False, 'message': 'Search text too short'}), 400
+
+    try:
+        limit = max(1, min(int(request.args.get('limit', SEARCH_MAX_RESULTS)), SEARCH_MAX_RESULTS))
+        matches = search_configs(text, limit)
+        return jsonify({
+            'success': True,
+            'query': escape(text),
+            'all_versions': SEARCH_ALL_VERSIONS,
+            'devices': sorted({m['folder'] for m in matches}),
+            'truncated': len(matches) >= limit,
+            'results': [{
+                'hostname': m['folder'],
+                'filename': m['filename'],
+                'path': os.path.join(BACKUP_DIR, m['folder'], m['filename']),
+                'line': m['line_no'],
+                'text': escape(m['text'])
+            } for m in matches]
+        })
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error searching configurations: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+@app.route('/backup_trends', methods=['GET'])
+@login_required
+def backup_trends():
+    """Telemetry of one device (id or index): daily series over the last days plus its most recent runs."""
+    try:
+        if request.args.get('id'):
+            switch = get_switch_by_id(int(request.args['id']))
+        else:
+            switch = get_switch(int(request.args.get('index', -1)))
+        if not switch:
+            return jsonify({'success': False, 'message': 'Switch not found'}), 404
+        days = max(1, min(int(request.args.get('days', 30)), 3660))
+        since_day = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+
+        series = telemetry_days(since_day, switch['id'])
+        recent = [dict(row) for row in get_db().execute(
+            f"SELECT {', '.join(TELEMETRY_FIELDS)} FROM backup_runs WHERE device_id = ? ORDER BY started_at DESC LIMIT 20",
+            (switch['id'],)
+        )]
+        return jsonify({
+            'success': True,
+            'hostname': switch['hostname'],
+            'summary': summarize_telemetry(series),
+            'series': series,
+            'recent': recent
+        })
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error reading backup trends: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+@app.route('/fleet_trends', methods=['GET'])
+@login_required
+def fleet_trends():
+    """Fleet telemetry over the last days: daily totals and the devices ranked by average backup time."""
+    try:
+        days = max(1, min(int(request.args.get('days', 7)), 3660))
+        limit = max(1, min(int(request.args.get('limit', 20)), 1000))
+        since_day = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        rows = telemetry_days(since_day)
+
+        by_day, by_device = OrderedDict(), {}
+        for row in rows:
+            by_day.setdefault(row['day'], []).append(row)
+            by_device.setdefault(row['device_id'], []).append(row)
+        devices = [
+            {'id': device_id, 'hostname': device_rows[-1]['hostname'], **summarize_telemetry(device_rows)}
+            for device_id, device_rows in by_device.items()
+        ]
+        devices.sort(key=lambda d: d['avg_total'] or 0, reverse=True)
+        return jsonify({
+            'success': True,
+            'summary': summarize_telemetry(rows),
+            'series': [{'day': day, **summarize_telemetry(day_rows)} for day, day_rows in by_day.items()],
+            'slowest': devices[:limit]
+        })
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error reading fleet trends: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+@app.route('/get_retention_policy', methods=['GET'])
+@login_required
+def get_retention_policy():
+    return jsonify({'success': True, 'policy': load_retention_policy(), 'status': retention_status})
+
+@app.route('/set_retention_policy', methods=['POST'])
+@login_required
+def set_retention_policy():
+    data = request.get_json() or {}
+    try:
+        policy = validate_retention_policy(data)
+        save_retention_policy(policy)
+        logger.info(f"Retention policy updated: {policy}")
+        return jsonify({'success': True, 'message': 'Retention policy saved', 'policy': policy})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error saving retention policy: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+@app.route('/preview_retention', methods=['POST'])
+@login_required
+def preview_retention():
+    data = request.get_json() or {}
+    try:
+        policy = validate_retention_policy({**load_retention_policy(), **data.get('policy', {})})
+        if 'index' in data:
+            switch = get_switch(int(data['index']))
+            if not switch:
+                return jsonify({'success': False, 'message': 'Switch not found'}), 404
+            folders = [secure_filename(switch['hostname'])]
+        else:
+            folders = [row[0] for row in get_db().execute('SELECT DISTINCT folder FROM backup_catalog ORDER BY folder')]
+        preview = {}
+        for folder in folders:
+            keep, prune = retention_plan(catalog_list_versions(folder), policy)
+            preview[folder] = {'keep': len(keep), 'prune': [v['filename'] for v in prune]}
+        return jsonify({'success': True, 'policy': policy, 'devices': preview})
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error previewing retention: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
 # API per la gestione degli schedule
 @app.route('/add_schedule', methods=['POST'])
 @login_required
 def add_schedule():
-    data = request.get_json()
-    if not all(key in data for key in ['type', 'time']):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not all(key in data for key in ['type', 'time']):
         return jsonify({'success': False, 'message': 'Dati mancanti'})
     
-    schedule_id = f"sch_{int(time.time())}_{len(load_schedules())}"
-    data['id'] = schedule_id
-    data['created_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
-    schedules_data = load_schedules()
-    schedules_data.append(data)
-    save_schedules(schedules_data)
-    add_scheduled_job(data)
+    try:
+        schedule_id = create_schedule(data)['id']
+    except (KeyError, ValueError, TypeError) as e:
+        return jsonify({'success': False, 'message': f'Dati non validi: {str(e)}'})
     
     logger.info(f"New schedule added: {get_schedule_description(data)}")
     return jsonify({
@@ -3625,10 +6250,9 @@ def add_schedule():
 @login_required
 def get_schedules():
     schedules_data = load_schedules()
-    jobs = scheduler.get_jobs()
     
     for schedule in schedules_data:
-        job = next((j for j in jobs if j.id == schedule['id']), None)
+        job = scheduler.get_job(schedule['id']) if schedule.get('enabled', True) else None
         if job:
             schedule['next_run'] = job.next_run_time.strftime('%Y-%m-%d %H:%M:%S') if job.next_run_time else "N/A"
             schedule['enabled'] = True
@@ -3645,22 +6269,12 @@ def toggle_schedule():
     if not all(key in data for key in ['id', 'enabled']):
         return jsonify({'success': False, 'message': 'Dati mancanti'})
     
-    schedules_data = load_schedules()
-    schedule = next((s for s in schedules_data if s['id'] == data['id']), None)
+    schedule = set_schedule_enabled(data['id'], data['enabled'])
     
     if not schedule:
         return jsonify({'success': False, 'message': 'Pianificazione non trovata'})
     
-    if data['enabled']:
-        add_scheduled_job(schedule)
-        schedule['enabled'] = True
-        message = 'Pianificazione attivata'
-    else:
-        scheduler.remove_job(data['id'])
-        schedule['enabled'] = False
-        message = 'Pianificazione disattivata'
-    
-    save_schedules(schedules_data)
+    message = 'Pianificazione attivata' if data['enabled'] else 'Pianificazione disattivata'
     logger.info(f"Pianificazione {data['id']} {'attivata' if data['enabled'] else 'disattivata'}")
     return jsonify({'success': True, 'message': message})
 
@@ -3671,15 +6285,11 @@ def delete_schedule():
     if 'id' not in data:
         return jsonify({'success': False, 'message': 'ID mancante'})
     
-    schedules_data = load_schedules()
-    schedule = next((s for s in schedules_data if s['id'] == data['id']), None)
+    removed = remove_schedules(lambda s: s['id'] == data['id'])
     
-    if not schedule:
+    if not removed:
         return jsonify({'success': False, 'message': 'Pianificazione non trovata'})
-    
-    scheduler.remove_job(data['id'])
-    schedules_data = [s for s in schedules_data if s['id'] != data['id']]
-    save_schedules(schedules_data)
+    schedule = removed[0]
     
     logger.info(f"Eliminata pianificazione: {get_schedule_description(schedule)}")
     return jsonify({'success': True, 'message': 'Pianificazione eliminata'})
@@ -3693,54 +6303,332 @@ def log_event():
         logger.info(data['message'])
     return jsonify({'success': True})
 
-# API per il recupero dei log di sistema
+# Lettura dei log dalla fine, a pagine
+LOG_PAGE_MAX = 1000               # righe massime per pagina
+LOG_SCAN_BUDGET = 8 * 1024 * 1024 # byte letti al massimo per richiesta (filtri molto selettivi)
+LOG_READ_BLOCK = 64 * 1024
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+LOG_LINE_RE = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+ - (?:(DEBUG|INFO|WARNING|ERROR|CRITICAL) - )?(.*)$')
+
+def log_files_newest_first():
+    """events.log followed by the rotated files (plain or gzip archives), newest first."""
+    rotated = sorted(
+        (f for f in os.listdir(LOG_DIR) if ROTATED_LOG_RE.match(f)),
+        key=lambda f: (ROTATED_LOG_RE.match(f).group(1), f), reverse=True
+    ) if os.path.isdir(LOG_DIR) else []
+    files = [EVENTS_LOG] if os.path.exists(EVENTS_LOG) else []
+    return files + [os.path.join(LOG_DIR, f) for f in rotated]
+
+def read_lines_backward(f, end_offset):
+    """Yields (line, start_offset) of a binary file from end_offset towards the beginning."""
+    position = end_offset
+    remainder = b''
+    while position > 0:
+        size = min(LOG_READ_BLOCK, position)
+        position -= size
+        f.seek(position)
+        block = f.read(size) + remainder
+        lines = block.split(b'\n')
+        remainder = lines.pop(0)
+        offset = position + len(remainder) + 1
+        starts = []
+        for line in lines:
+            starts.append(offset)
+            offset += len(line) + 1
+        for line, start in zip(reversed(lines), reversed(starts)):
+            yield line.decode('utf-8', errors='replace'), start
+    if remainder:
+        yield remainder.decode('utf-8', errors='replace'), 0
+
+def iter_log_records_backward(f, end_offset):
+    """Yields (time, level, message, start_offset) newest first; continuation lines (tracebacks) join their record."""
+    continuation = []
+    for line, start in read_lines_backward(f, end_offset):
+        match = LOG_LINE_RE.match(line)
+        if not match:
+            if line.strip():
+                continuation.append(line)
+            continue
+        timestamp, record_level, message = match.groups()
+        if continuation:
+            message = '\n'.join([message] + continuation[::-1])
+            continuation = []
+        yield timestamp, record_level or 'INFO', message, start
+
+def iter_log_records(f):
+    """Yields (time, level, message, start_offset) in file order from a binary stream, e.g. a gzip archive."""
+    offset, current = 0, None
+    for raw in f:
+        line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+        match = LOG_LINE_RE.match(line)
+        if match:
+            if current:
+                yield tuple(current)
+            timestamp, record_level, message = match.groups()
+            current = [timestamp, record_level or 'INFO', message, offset]
+        elif current and line.strip():
+            current[2] += '\n' + line
+        offset += len(raw)
+    if current:
+        yield tuple(current)
+
+def open_log_file(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def log_record_filter(level=None, text=None, since=None, until=None):
+    """Predicate on (time, level, message) for the given filters; raises ValueError on an unknown level."""
+    min_level = LOG_LEVELS.get(level.upper()) if level else None
+    if level and min_level is None:
+        raise ValueError(f"Unknown log level: {level}")
+    needle = text.lower() if text else None
+    since_text = since.strftime('%Y-%m-%d %H:%M:%S') if since else None
+    until_text = until.strftime('%Y-%m-%d %H:%M:%S') if until else None
+
+    def accept(timestamp, record_level, message):
+        return ((not since_text or timestamp >= since_text)
+                and (not until_text or timestamp <= until_text)
+                and (min_level is None or LOG_LEVELS[record_level] >= min_level)
+                and (needle is None or needle in message.lower())
+                and 'werkzeug' not in message)
+    return accept
+
+def log_file_day(path):
+    """Rotation date a log file is (or will be) archived under: it names the file whether plain or compressed."""
+    match = ROTATED_LOG_RE.match(os.path.basename(path))
+    if match:
+        return match.group(1)
+    # events.log: il giorno che il rotatore userà per rinominarlo
+    return time.strftime('%Y-%m-%d', time.localtime(file_handler.rolloverAt - file_handler.interval))
+
+def log_file_size(path):
+    """Uncompressed size in bytes; for gzip archives it is read from the trailer (ISIZE)."""
+    if not path.endswith('.gz'):
+        return os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), 'little')
+
+def _encode_log_cursor(path, offset):
+    return f"{log_file_day(path)}:{offset}"
+
+def _decode_log_cursor(cursor, files):
+    """
+    Cursors name a file by its rotation date and hold an offset into its uncompressed content,
+    so they stay valid when the file is rotated and then gzipped.
+    """
+    day, _, offset = cursor.partition(':')
+    if not re.match(r'^\d{4}-\d{2}-\d{2}$', day) or not offset.isdigit():
+        raise ValueError("Invalid log cursor")
+    offset = int(offset)
+    for position, path in enumerate(files):
+        if log_file_day(path) == day:
+            if offset > log_file_size(path):
+                raise ValueError("Invalid log cursor")
+            return position, offset
+    raise ValueError("Log cursor expired")
+
+def read_log_page(limit=200, cursor=None, level=None, hostname=None, since=None, until=None):
+    """
+    Newest-first log records matching the filters. Plain files are read backwards from the end;
+    gzip archives are streamed forward keeping only the newest matches still needed.
+    Returns (entries, next_cursor); next_cursor is None when the history is exhausted.
+    """
+    files = log_files_newest_first()
+    position, offset = _decode_log_cursor(cursor, files) if cursor else (0, None)
+    accept = log_record_filter(level, hostname, None, until)
+    since_text = since.strftime('%Y-%m-%d %H:%M:%S') if since else None
+
+    entries, scanned = [], 0
+    for position in range(position, len(files)):
+        path = files[position]
+        end, offset = offset, None
+        has_older = position + 1 < len(files)
+
+        if path.endswith('.gz'):
+            matches = deque(maxlen=limit - len(entries))
+            reached_since = False
+            with open_log_file(path) as f:
+                for timestamp, record_level, message, start in iter_log_records(f):
+                    if end is not None and start >= end:
+                        break
+                    if since_text and timestamp < since_text:
+                        reached_since = True
+                    elif accept(timestamp, record_level, message):
+                        matches.append({'time': timestamp, 'level': record_level, 'message': message, 'start': start})
+            full = len(matches) == matches.maxlen
+            for match in reversed(matches):
+                oldest_start = match.pop('start')
+                entries.append(match)
+            if full:
+                more = oldest_start > 0 or has_older
+                return entries, (_encode_log_cursor(path, oldest_start) if more else None)
+            if reached_since:
+                return entries, None
+            continue
+
+        with open(path, 'rb') as f:
+            if end is None:
+                end = os.fstat(f.fileno()).st_size
+            for timestamp, record_level, message, start in iter_log_records_backward(f, end):
+                scanned += len(message) + 1
+                if since_text and timestamp < since_text:
+                    return entries, None
+                if accept(timestamp, record_level, message):
+                    entries.append({'time': timestamp, 'level': record_level, 'message': message})
+                # Il cursore punta all'inizio dell'ultimo record letto
+                if len(entries) >= limit or scanned >= LOG_SCAN_BUDGET:
+                    return entries, (_encode_log_cursor(path, start) if start > 0 or has_older else None)
+    return entries, None
+
+def search_log_archives(text=None, level=None, since=None, until=None, limit=10000):
+    """Yields matching log lines oldest first, decompressing archives as a stream; files outside the range are skipped."""
+    accept = log_record_filter(level, text, since, until)
+    since_day = since.strftime('%Y-%m-%d') if since else None
+    until_day = until.strftime('%Y-%m-%d') if until else None
+    found = 0
+    for path in reversed(log_files_newest_first()):
+        match = ROTATED_LOG_RE.match(os.path.basename(path))
+        if match and ((since_day and match.group(1) < since_day) or (until_day and match.group(1) > until_day)):
+            continue
+        with open_log_file(path) as f:
+            for timestamp, record_level, message, _ in iter_log_records(f):
+                if accept(timestamp, record_level, message):
+                    yield f"{timestamp} - {record_level} - {message}\n"
+                    found += 1
+                    if found >= limit:
+                        return
+
+def _parse_log_time(value, end_of_day=False):
+    value = value.strip().replace('T', ' ')
+    if ':' in value:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    day = datetime.strptime(value, '%Y-%m-%d')
+    return day.replace(hour=23, minute=59, second=59) if end_of_day else day
+
+@app.route('/get_log_page', methods=['GET'])
+@login_required
+def get_log_page():
+    """
+    Paginated log, newest first: limit, cursor (next_cursor of the previous page) and the optional
+    filters level (minimum level), hostname (text in the message), since and until.
+    """
+    try:
+        limit = max(1, min(int(request.args.get('limit', 200)), LOG_PAGE_MAX))
+        since = _parse_log_time(request.args['since']) if request.args.get('since') else None
+        until = _parse_log_time(request.args['until'], end_of_day=True) if request.args.get('until') else None
+        entries, next_cursor = read_log_page(
+            limit=limit,
+            cursor=request.args.get('cursor') or None,
+            level=request.args.get('level') or None,
+            hostname=request.args.get('hostname') or None,
+            since=since,
+            until=until
+        )
+        for entry in entries:
+            entry['message'] = escape(entry['message'])
+        return jsonify({'success': True, 'entries': entries, 'next_cursor': next_cursor})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error reading log page: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+def query_events(device_id=None, hostname=None, event_type=None, outcome=None, since=None, until=None,
+                 order='time', limit=100, before=None):
+    """Indexed lookup over the structured event log; rows are newest first, or slowest first with order='duration'."""
+    query = f"SELECT id, {', '.join(EVENT_INDEX_FIELDS)} FROM event_index WHERE 1 = 1"
+    args = []
+    for column, value in (('device_id', device_id), ('hostname', hostname), ('event_type', event_type), ('outcome', outcome)):
+        if value is not None:
+            query += f' AND {column} = ?'
+            args.append(value)
+    if since:
+        query += ' AND time >= ?'
+        args.append(since.strftime('%Y-%m-%d %H:%M:%S'))
+    if until:
+        query += ' AND time <= ?'
+        args.append(until.strftime('%Y-%m-%d %H:%M:%S'))
+    if order == 'duration':
+        query += ' AND duration IS NOT NULL ORDER BY duration DESC'
+    else:
+        if before:
+            query += ' AND id < ?'
+            args.append(int(before))
+        query += ' ORDER BY id DESC'
+    query += ' LIMIT ?'
+    args.append(int(limit))
+    return [dict(row) for row in get_db().execute(query, args)]
+
+@app.route('/query_events', methods=['GET'])
+@login_required
+def query_events_api():
+    """
+    Structured events from the index: filters device_id, hostname, type, outcome (success/failure),
+    since/until; order=time (default, paged with before=<id>) or order=duration; full=1 adds the JSON record.
+    Example: ?type=backup_finish&order=duration&since=2026-01-01&until=2026-01-01&limit=50
+    """
+    try:
+        args = request.args
+        order = args.get('order', 'time')
+        if order not in ('time', 'duration'):
+            raise ValueError("order must be 'time' or 'duration'")
+        limit = max(1, min(int(args.get('limit', 100)), LOG_PAGE_MAX))
+        rows = query_events(
+            device_id=int(args['device_id']) if args.get('device_id') else None,
+            hostname=args.get('hostname') or None,
+            event_type=args.get('type') or None,
+            outcome=args.get('outcome') or None,
+            since=_parse_log_time(args['since']) if args.get('since') else None,
+            until=_parse_log_time(args['until'], end_of_day=True) if args.get('until') else None,
+            order=order,
+            limit=limit,
+            before=args.get('before') or None
+        )
+        for row in rows:
+            location = (row.pop('file'), row.pop('offset'))
+            if args.get('full') == '1':
+                try:
+                    row['record'] = read_event_record(*location)
+                except (OSError, ValueError):
+                    row['record'] = None
+        next_before = rows[-1]['id'] if order == 'time' and len(rows) == limit else None
+        return jsonify({'success': True, 'events': rows, 'next_before': next_before})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error querying events: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+@app.route('/search_logs', methods=['GET'])
+@login_required
+def search_logs():
+    """
+    Streams the log records matching q (text), level, since and until as text/plain, oldest first,
+    across the current log and the compressed archives (at most limit records).
+    """
+    try:
+        args = request.args
+        since = _parse_log_time(args['since']) if args.get('since') else None
+        until = _parse_log_time(args['until'], end_of_day=True) if args.get('until') else None
+        limit = max(1, min(int(args.get('limit', 10000)), 100000))
+        lines = search_log_archives(args.get('q') or None, args.get('level') or None, since, until, limit)
+        first = next(lines, '')
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    def generate():
+        if first:
+            yield first
+        yield from lines
+    return Response(generate(), mimetype='text/plain')
+
+# API per il recupero dei log di sistema (ultime LOG_PAGE_MAX righe, per compatibilità)
 @app.route('/get_full_log', methods=['GET'])
 @login_required
 def get_full_log():
     try:
-        log_lines = []
-        
-        # Recupero i log storici
-        if os.path.exists(LOG_DIR):
-            for filename in sorted(os.listdir(LOG_DIR), reverse=False):
-                if filename.startswith('events.') and filename.endswith('.log') and filename != 'events.log':
-                    filepath = os.path.join(LOG_DIR, filename)
-                    with open(filepath, 'r') as f:
-                        # Filtro solo le righe che iniziano con timestamp e non contengono werkzeug
-                        file_lines = [
-                            line for line in f.readlines()
-                            if line.strip() and "werkzeug" not in line
-                        ]
-                        if file_lines:
-                            log_lines.extend(file_lines)
-                            # Aggiungi separatore e contenuto del file
-                            log_lines.append("\n" + "-"*80)
-                            log_lines.append("\n>")
-                            log_lines.append(f">> Log file: {filename}")
-                            log_lines.append("\n>")
-                            log_lines.append("-"*80 + "\n")
-        
-        #Recupero il log corrente
-        if os.path.exists(EVENTS_LOG):
-            with open(EVENTS_LOG, 'r') as f:
-                # Filtro solo le righe che iniziano con timestamp e non contengono werkzeug
-                file_lines = [
-                    line for line in f.readlines()
-                    if line.strip() and "werkzeug" not in line
-                ]
-                if file_lines:
-                    log_lines.extend(file_lines)
-                    # Aggiungi separatore e contenuto del file
-                    log_lines.append("\n" + "-"*80)
-                    log_lines.append("\n>")
-                    log_lines.append(f">> Log file: {EVENTS_LOG}")
-                    log_lines.append("\n>")
-                    log_lines.append("-"*80 + "\n")
-        
-        # Inverti le righe per mostrare i log più recenti in alto, poi restituisci il contenuto
-        log_lines.reverse()
-        full_log = "\n".join(log_lines)
-        
+        entries, _ = read_log_page(limit=LOG_PAGE_MAX)
+        full_log = "\n".join(f"{e['time']} - {e['level']} - {e['message']}" for e in entries)
         return jsonify({'success': True, 'log': escape(full_log)})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -3764,16 +6652,15 @@ def upload_csv():
         stream = io.StringIO(csv_file.stream.read().decode('UTF-8'))
         csv_reader = csv.DictReader(stream)
         
-        switches_data = load_switches()
-        added = 0
+        new_switches = []
         skipped = 0
-        existing_ips = {sw['ip'] for sw in switches_data}
+        seen_ips = set()
         
         for row in csv_reader:
             if not all(field in row for field in ['hostname', 'ip', 'username', 'password']):
                 return jsonify({'success': False, 'message': 'CSV format not valid'})
             
-            if row['ip'] in existing_ips:
+            if row['ip'] in seen_ips or switch_ip_exists(row['ip']):
                 skipped += 1
                 continue
             
@@ -3781,19 +6668,19 @@ def upload_csv():
             encrypted_password = encrypt_password(row['password'])
             encrypted_enable_password = encrypt_password(row.get('enable_password', row['password']))
             
-            switches_data.append({
+            new_switches.append({
                 'hostname': row['hostname'],
                 'ip': row['ip'],
                 'username': row['username'],
                 'password': encrypted_password,
                 'enable_password': encrypted_enable_password,
-                'device_type': row.get('device_type', 'cisco_ios')
+                'device_type': row.get('device_type') or 'cisco_ios'
             })
-            existing_ips.add(row['ip'])
-            added += 1
+            seen_ips.add(row['ip'])
         
+        added = len(new_switches)
         if added > 0:
-            save_switches(switches_data)
+            insert_switches(new_switches)
             logger.info(f"Loaded {added} devices from CSV, {skipped} already present")
         
         return jsonify({
@@ -3834,6 +6721,131 @@ def export_switches_csv():
         logger.error(f"Error during the export of CSV: {str(e)}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
+# Esportazione ZIP delle configurazioni, generata in streaming
+ZIP_SPOOL_MAX_SIZE = 1024 * 1024  # byte di una versione tenuti in memoria prima di passare a un file temporaneo
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Write-only, non-seekable sink for zipfile; the generator drains it after every write."""
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def version_as_of(folder, at=None):
+    """Logical file name of the newest version of a device folder created at or before 'at', or None."""
+    at_text = at.strftime('%Y-%m-%d %H:%M:%S') if at else None
+    if catalog_ready():
+        query = 'SELECT filename FROM backup_catalog WHERE folder = ?'
+        args = [folder]
+        if at_text:
+            query += ' AND created_at <= ?'
+            args.append(at_text)
+        row = get_db().execute(query + ' ORDER BY filename DESC LIMIT 1', args).fetchone()
+        return row[0] if row else None
+    switch_folder = os.path.join(BACKUP_DIR, folder)
+    for filename in list_versions(switch_folder):
+        if not at_text or _version_timestamp(filename, os.path.join(switch_folder, filename)) <= at_text:
+            return filename
+    return None
+
+def generate_backups_zip(switches, at=None):
+    """Yields a ZIP of the selected version of each device plus a manifest, one file at a time."""
+    sink = ZipStreamBuffer()
+    manifest = io.StringIO()
+    writer = csv.writer(manifest)
+    writer.writerow(['hostname', 'ip', 'file', 'timestamp', 'sha256', 'status'])
+    exported = 0
+
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for switch in switches:
+            folder = secure_filename(switch['hostname'])
+            filename = version_as_of(folder, at)
+            if not filename:
+                writer.writerow([switch['hostname'], switch['ip'], '', '', '', 'missing'])
+                continue
+            version_path = os.path.join(BACKUP_DIR, folder, filename)
+            timestamp = _version_timestamp(filename, version_path + VERSION_REF_SUFFIX)
+            info = zipfile.ZipInfo(f'{folder}/{filename}', date_time=datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            content_hash = hashlib.sha256()
+            # La versione viene letta per intero prima di aprire la voce dell'archivio: un errore di lettura
+            # a meta' non puo' lasciare nello ZIP un file troncato
+            with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE, dir=STORE_TMP_DIR) as staged:
+                try:
+                    with open_version(version_path) as src:
+                        for chunk in iter(lambda: src.read(65536), ''):
+                            data = chunk.encode('utf-8')
+                            content_hash.update(data)
+                            staged.write(data)
+                except Exception as e:
+                    logger.error(f"Unable to export {version_path}: {str(e)}")
+                    writer.writerow([switch['hostname'], switch['ip'], info.filename, timestamp, '', 'failed'])
+                    continue
+                staged.seek(0)
+                with archive.open(info, 'w') as dst:
+                    for data in iter(lambda: staged.read(65536), b''):
+                        dst.write(data)
+                        yield sink.drain()
+            writer.writerow([switch['hostname'], switch['ip'], info.filename, timestamp, content_hash.hexdigest(), 'ok'])
+            exported += 1
+            yield sink.drain()
+        archive.writestr('manifest.csv', manifest.getvalue())
+    yield sink.drain()
+    logger.info(f"Exported {exported} of {len(switches)} device configurations as ZIP")
+
+@app.route('/export_backups_zip', methods=['GET'])
+@login_required
+def export_backups_zip():
+    """
+    Streams a ZIP with the latest backup of every device, optionally filtered by hostname
+    (comma-separated substrings), device_type and subnet, or as of a point in time (at).
+    """
+    try:
+        switches = load_switches()
+        hostnames = [h.strip().lower() for h in request.args.get('hostname', '').split(',') if h.strip()]
+        if hostnames:
+            switches = [s for s in switches if any(h in s['hostname'].lower() for h in hostnames)]
+        device_type = request.args.get('device_type', '').strip()
+        if device_type:
+            switches = [s for s in switches if s.get('device_type') == device_type]
+        subnet = request.args.get('subnet', '').strip()
+        if subnet:
+            network = ipaddress.ip_network(subnet, strict=False)
+            switches = [s for s in switches if validate_ip(s['ip']) and ipaddress.ip_address(s['ip']) in network]
+
+        at = None
+        if request.args.get('at'):
+            at_text = request.args['at'].strip().replace('T', ' ')
+            at = datetime.strptime(at_text, '%Y-%m-%d %H:%M:%S' if ':' in at_text else '%Y-%m-%d')
+            if ':' not in at_text:
+                at = at.replace(hour=23, minute=59, second=59)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Invalid filter: {str(e)}'}), 400
+
+    suffix = at.strftime('%Y%m%d_%H%M%S') if at else datetime.now().strftime('%Y%m%d')
+    logger.info(f"Streaming ZIP export of {len(switches)} devices" + (f" as of {at}" if at else ""))
+    return Response(
+        generate_backups_zip(switches, at),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=pickled_configs_{suffix}.zip'}
+    )
+
+
+# Avvio dei servizi in background
+bootstrap_schedules()
+threading.Thread(target=store_maintenance, name='store-maintenance', daemon=True).start()
+threading.Thread(target=retention_worker, name='retention', daemon=True).start()
+threading.Thread(target=archive_rotated_logs, name='log-archive', daemon=True).start()
 
 if __name__ == '__main__':
 	app.run(host='0.0.0.0', port=5000, debug=False)